@@ -0,0 +1,26 @@
+import argparse
+
+
+def positive_int(text):
+    """argparse type for counts and sizes that have to be above zero."""
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {text!r}')
+
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f'{value} is not above zero')
+
+    return value
+
+
+def positive_float(text):
+    try:
+        value = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid float value: {text!r}')
+
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f'{value} is not above zero')
+
+    return value
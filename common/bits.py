@@ -0,0 +1,173 @@
+import os
+
+
+class BitWriter:
+    """Packs bits most significant first into a bytearray."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.accumulator = 0
+        self.count = 0
+        self.taken = 0
+
+    def __len__(self):
+        return (self.taken + len(self.buffer)) * 8 + self.count
+
+    def write_bits(self, value, n):
+        self.accumulator = (self.accumulator << n) | value
+        self.count += n
+
+        if self.count >= 64:
+            self._flush()
+
+    def write_codes(self, codes):
+        """Writes every (value, n) pair of codes, like write_bits would."""
+        accumulator = self.accumulator
+        count = self.count
+        buffer = self.buffer
+
+        for value, n in codes:
+            accumulator = (accumulator << n) | value
+            count += n
+
+            if count >= 64:
+                full, count = divmod(count, 8)
+                buffer += (accumulator >> count).to_bytes(full, 'big')
+                accumulator &= (1 << count) - 1
+
+        self.accumulator = accumulator
+        self.count = count
+
+    def write_bit(self, bit):
+        self.write_bits(bit, 1)
+
+    def _flush(self):
+        full, self.count = divmod(self.count, 8)
+        self.buffer += (self.accumulator >> self.count).to_bytes(full, 'big')
+        self.accumulator &= (1 << self.count) - 1
+
+    def pop_bytes(self):
+        """Returns the complete bytes written since the last call."""
+        self._flush()
+        result = bytes(self.buffer)
+        self.taken += len(self.buffer)
+        self.buffer.clear()
+
+        return result
+
+    def getvalue(self):
+        """Returns the bits not taken by pop_bytes, padded with zeros."""
+        self._flush()
+        if self.count == 0:
+            return bytes(self.buffer)
+
+        return bytes(self.buffer) + (self.accumulator << (8 - self.count)).to_bytes(1, 'big')
+
+
+class BitReader:
+    """Reads bits most significant first from a bytes-like object."""
+
+    def __init__(self, data, start=0, end=None):
+        self.data = data
+        self.position = start
+        self.end = len(data) * 8 if end is None else end
+
+    @property
+    def remaining(self):
+        return self.end - self.position
+
+    def read_bit(self):
+        if self.position >= self.end:
+            raise EOFError('no more bits to read')
+
+        bit = (self.data[self.position >> 3] >> (7 - (self.position & 7))) & 1
+        self.position += 1
+
+        return bit
+
+    def read_zeros(self):
+        """Skips the zeros before the next 1 bit and returns their number.
+
+        Returns None if the stream ends before a 1 bit.
+        """
+        zeros = 0
+        while True:
+            n = min(self.remaining, 64)
+            if n <= 0:
+                return None
+
+            window = self.peek_bits(n)
+            if window:
+                run = n - window.bit_length()
+                self.position += run
+                return zeros + run
+
+            zeros += n
+            self.position += n
+
+    def read_bits(self, n):
+        value = self.peek_bits(n)
+        self.position += n
+
+        return value
+
+    def skip_bits(self, n):
+        self.position += n
+
+    def take_bits(self, n):
+        """Reads n bits or what is left if fewer, returns them and their number."""
+        n = min(n, self.remaining)
+        if n <= 0:
+            return 0, 0
+
+        return self.read_bits(n), n
+
+    def peek_bits(self, n):
+        if self.position + n > self.end:
+            raise EOFError('no more bits to read')
+
+        first = self.position >> 3
+        last = (self.position + n + 7) >> 3
+        chunk = int.from_bytes(self.data[first:last], 'big')
+
+        return (chunk >> (last * 8 - self.position - n)) & ((1 << n) - 1)
+
+
+# streams of bits written with start_bits begin with 3 bits holding the
+# number of padding bits in their last byte
+
+def start_bits():
+    writer = BitWriter()
+    # room for the padding length, filled in by write_bits
+    writer.write_bits(0, 3)
+
+    return writer
+
+
+def write_bits(writer, pieces, file):
+    start = file.tell()
+    for piece in pieces:
+        file.write(piece)
+    file.write(writer.getvalue())
+
+    padding = (8 - len(writer) % 8) % 8
+    file.seek(start)
+    first = file.read(1)[0]
+    file.seek(start)
+    file.write(bytes([first | padding << 5]))
+    file.seek(0, os.SEEK_END)
+
+
+def finish_bits(writer):
+    """Returns what write_bits would write for a writer from start_bits."""
+    data = bytearray(writer.getvalue())
+    data[0] |= (-len(writer) % 8) << 5
+
+    return bytes(data)
+
+
+def read_bits(data):
+    """Returns a reader over what write_bits wrote, padding excluded."""
+    padding_len = data[0] >> 5
+
+    return BitReader(data, start=3, end=len(data) * 8 - padding_len)
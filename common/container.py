@@ -0,0 +1,183 @@
+import io
+import struct
+import sys
+import zlib
+
+from common.streams import CHUNK_SIZE, map_input
+
+
+# the container is a header, the blocks one after another, an index with
+# an entry per block and a footer pointing at the index, so blocks can be
+# written as they come and still be found without reading the others
+MAGIC = b'KMPB'
+VERSION = 2
+
+# ids of the coders writing containers, kept in the header
+CODECS = {
+    'huffman': 1,
+    'lzw': 2,
+    'filters': 3,
+    'jpeg-ls': 4,
+}
+
+# magic, version, codec id, length of the codec parameters that follow
+HEADER = struct.Struct('<4sBBH')
+# offset and length of a block in the file, length of the data it encodes,
+# CRC32 of the block
+INDEX_ENTRY = struct.Struct('<QQQI')
+# offset of the index, number of blocks, CRC32 of the header, codec
+# parameters and index, magic again
+FOOTER = struct.Struct('<QQI4s')
+
+
+class CorruptedBlock(ValueError):
+    """A block, or the header, parameters or index describing the blocks,
+    does not match its checksum."""
+
+
+class ContainerWriter:
+    def __init__(self, file, codec, params=b''):
+        self.file = file
+        self.index = []
+        self.block_start = None
+
+        header = HEADER.pack(MAGIC, VERSION, CODECS[codec], len(params)) + params
+        file.write(header)
+        self.offset = len(header)
+        self.crc = zlib.crc32(header)
+
+    def write_block(self, payload, size):
+        self.file.write(payload)
+        self.index.append((self.offset, len(payload), size, zlib.crc32(payload)))
+        self.offset += len(payload)
+
+    def begin_block(self):
+        """Starts a block the caller writes to the file itself.
+
+        Until end_block the caller may seek back within the block, the
+        checksum is computed afterwards by reading the block back.
+        """
+        self.block_start = self.offset
+
+    def end_block(self, size):
+        end = self.file.seek(0, io.SEEK_END)
+
+        crc = 0
+        self.file.seek(self.block_start)
+        for chunk in read_range(self.file, end - self.block_start):
+            crc = zlib.crc32(chunk, crc)
+
+        self.index.append((self.block_start, end - self.block_start, size, crc))
+        self.offset = end
+        self.block_start = None
+
+    def close(self):
+        index = b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index)
+        self.file.write(index)
+
+        self.file.write(FOOTER.pack(self.offset, len(self.index), zlib.crc32(index, self.crc), MAGIC))
+
+
+class ContainerReader:
+    """Reads a container from a bytes-like object, such as a memoryview of
+    a mapped file, without copying the blocks out of it."""
+
+    def __init__(self, data):
+        self.data = data
+
+        if not is_container(data):
+            raise ValueError('not a block container')
+
+        if len(data) < HEADER.size + FOOTER.size:
+            raise CorruptedBlock('truncated block container')
+        _, version, self.codec, params_length = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f'unsupported container version {version}')
+
+        # the rest is not trusted before the checksum is checked
+        index_offset, count, expected, magic = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+
+        header_end = HEADER.size + params_length
+        index_end = index_offset + count * INDEX_ENTRY.size
+        if magic != MAGIC or not header_end <= index_offset <= index_end <= len(data) - FOOTER.size:
+            raise CorruptedBlock('truncated block container')
+
+        crc = zlib.crc32(data[:header_end])
+        if zlib.crc32(data[index_offset:index_end], crc) != expected:
+            raise CorruptedBlock('the container header or index is corrupted')
+
+        self.params = bytes(data[HEADER.size:header_end])
+
+        self.index = [INDEX_ENTRY.unpack_from(data, index_offset + i * INDEX_ENTRY.size)
+                      for i in range(count)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def check_codec(self, codec):
+        if self.codec != CODECS[codec]:
+            raise ValueError(f'the container was not written by the {codec} coder')
+
+    def block_size(self, i):
+        """Length of the data encoded in block i."""
+        return self.index[i][2]
+
+    def read_block(self, i):
+        """Returns block i as a slice of the data, after checking it."""
+        offset, length, _, expected = self.index[i]
+
+        block = self.data[offset:offset + length]
+        if zlib.crc32(block) != expected:
+            raise CorruptedBlock(f'block {i} is corrupted')
+
+        return block
+
+    def read_blocks(self):
+        for i in range(len(self)):
+            yield self.read_block(i)
+
+    def verify(self):
+        """Checks every block against its checksum without decoding it."""
+        for i in range(len(self)):
+            self.read_block(i)
+
+
+def verify_file(path, codec):
+    """Checks a container written by codec, returns its number of blocks.
+
+    Raises ValueError, CorruptedBlock included, if the file is damaged.
+    """
+    with map_input(path) as data:
+        container = ContainerReader(data)
+        container.check_codec(codec)
+        container.verify()
+
+        return len(container)
+
+
+def report_verification(path, codec):
+    """Runs verify_file for the --verify option of a lab script.
+
+    Prints the number of blocks if path is intact, exits with the error
+    otherwise.
+    """
+    try:
+        blocks = verify_file(path, codec)
+    except ValueError as error:
+        sys.exit(f'{path}: {error}')
+
+    print(f'{path}: {blocks} blocks OK')
+
+
+def read_range(file, length, chunk_size=CHUNK_SIZE):
+    while length > 0:
+        chunk = file.read(min(length, chunk_size))
+        if not chunk:
+            return
+
+        length -= len(chunk)
+        yield chunk
+
+
+def is_container(data):
+    return bytes(data[:len(MAGIC)]) == MAGIC
@@ -0,0 +1,29 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def ordered_map(function, iterable, jobs=None):
+    """Like map, but runs function in jobs worker processes.
+
+    Results come back in order and only a couple of items per worker are
+    taken from iterable ahead of them, so it can be read lazily.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    if jobs <= 1:
+        yield from map(function, iterable)
+        return
+
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = deque()
+
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
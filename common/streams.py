@@ -0,0 +1,95 @@
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+
+CHUNK_SIZE = 1 << 16
+
+
+@contextmanager
+def open_input(path, mode='r'):
+    """Opens path for reading, '-' stands for the standard input."""
+    if path == '-':
+        yield sys.stdin.buffer if 'b' in mode else sys.stdin
+    else:
+        with open(path, mode) as f:
+            yield f
+
+
+@contextmanager
+def map_input(path):
+    """Yields the contents of path as a read-only memoryview.
+
+    Files are memory mapped rather than read into the heap. The standard
+    input and empty files cannot be mapped, so they are read instead; callers
+    that only need a single pass over the standard input should stream it
+    with read_chunks.
+    """
+    if path == '-':
+        yield memoryview(sys.stdin.buffer.read())
+        return
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b'')
+            return
+
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapping)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            # slices of the view are still around, the mapping is closed
+            # once they are collected
+            pass
+
+
+@contextmanager
+def open_output(path, mode='w'):
+    """Opens path for writing, '-' stands for the standard output."""
+    if path == '-':
+        stream = sys.stdout.buffer if 'b' in mode else sys.stdout
+        yield stream
+        stream.flush()
+    else:
+        with open(path, mode) as f:
+            yield f
+
+
+@contextmanager
+def open_patchable_output(path):
+    """Opens path for binary writing with support for seeking back.
+
+    The standard output cannot be rewound, so for '-' the data goes to a
+    temporary file first and is copied out once it is complete.
+    """
+    if path == '-':
+        with tempfile.TemporaryFile() as f:
+            yield f
+            f.seek(0)
+            shutil.copyfileobj(f, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+    else:
+        with open(path, 'w+b') as f:
+            yield f
+
+
+def view_chunks(view, chunk_size=CHUNK_SIZE):
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def read_chunks(file, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,33 @@
+import numpy as np
+
+
+HEADER_SIZE = 18
+FOOTER_SIZE = 26
+
+
+def load_tga(data):
+    """Reads an uncompressed 24-bit TGA image from a bytes-like object.
+
+    Returns the pixels as a (height, width, 3) uint8 array of red, green
+    and blue values with the top row first, together with the header and
+    footer bytes. The file stores rows bottom up in blue, green, red order,
+    so the array is a flipped view of data rather than a copy.
+    """
+    header = bytes(data[:HEADER_SIZE])
+    footer = bytes(data[len(data) - FOOTER_SIZE:])
+    width = data[13] * 256 + data[12]
+    height = data[15] * 256 + data[14]
+
+    pixels = np.frombuffer(data, np.uint8, width * height * 3, HEADER_SIZE)
+
+    return pixels.reshape(height, width, 3)[::-1, :, ::-1], header, footer
+
+
+def tga_pixels(pixels):
+    """Returns the bytes of a (height, width, 3) array in the TGA order."""
+    return np.ascontiguousarray(pixels[::-1, :, ::-1], np.uint8).tobytes()
+
+
+def file_order(pixels):
+    """Flattens a (height, width, 3) array to (blue, green, red) rows in the TGA order."""
+    return pixels[::-1, :, ::-1].reshape(-1, 3)
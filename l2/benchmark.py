@@ -0,0 +1,66 @@
+import os
+import sys
+from time import perf_counter
+
+from main import AdaptiveHuffman, VitterAdaptiveHuffman, entropy
+from common.bits import BitReader
+
+
+DEFAULT_INPUT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', 'l1', 'tests', 'pan-tadeusz-czyli-ostatni-zajazd-na-litwie.txt'
+)
+
+
+class LinearScanAdaptiveHuffman(AdaptiveHuffman):
+    """Finds block leaders by scanning the node array, like the old update."""
+
+    def find_largest_node(self, weight):
+        for n in reversed(self.nodes):
+            if n is not None and n.weight == weight:
+                return n
+
+
+CODERS = [
+    ('fgk (linear scan)', LinearScanAdaptiveHuffman),
+    ('fgk', AdaptiveHuffman),
+    ('vitter', VitterAdaptiveHuffman),
+]
+
+
+def measure(coder_class, text):
+    start = perf_counter()
+    bits = coder_class().encode(text)
+    encode_time = perf_counter() - start
+
+    start = perf_counter()
+    decoded = coder_class().decode(BitReader(bits.getvalue(), end=len(bits)))
+    decode_time = perf_counter() - start
+
+    assert decoded == text
+
+    return len(bits), encode_time, decode_time
+
+
+def main():
+    files = sys.argv[1:] or [DEFAULT_INPUT]
+
+    for file in files:
+        with open(file, 'rb') as f:
+            text = f.read()
+
+        megabytes = len(text) / 2**20
+
+        print(f'{file}: {len(text)} symbols')
+        print(f'Entropy: {entropy(text)}')
+
+        for name, coder_class in CODERS:
+            length, encode_time, decode_time = measure(coder_class, text)
+            print(f'{name}: average length {length / len(text):.4f}, '
+                  f'encode {megabytes / encode_time:.3f} MB/s, '
+                  f'decode {megabytes / decode_time:.3f} MB/s')
+        print('---')
+
+
+if __name__ == "__main__":
+    main()
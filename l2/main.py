@@ -1,44 +1,110 @@
 import argparse
+import json
+import os
 import sys
-from collections import defaultdict
+from collections import Counter
+from contextlib import ExitStack
 from math import log
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.bits import BitWriter, read_bits, start_bits, write_bits
+from common.container import ContainerReader, ContainerWriter, is_container, report_verification
+from common.streams import CHUNK_SIZE, map_input, open_input, open_output, open_patchable_output, read_chunks, view_chunks
+
+
+MAX_SYMBOLS = 256
+MAX_NODES = 2 * MAX_SYMBOLS
+# number of bits resolved with a single lookup while decoding
+DECODE_BITS = 8
+
 
 class Node:
-    def __init__(self, parent=None, left=None, right=None, weight=0, symbol=''):
+    def __init__(self, parent=None, left=None, right=None, weight=0, symbol=None, order=None):
         self.parent = parent
         self.left = left
         self.right = right
         self.weight = weight
         self.symbol = symbol
+        self.order = order
+        # decoding table: next DECODE_BITS bits -> (node reached, bits used)
+        self.table = None
 
 class AdaptiveHuffman:
     def __init__(self):
         self.NYT = Node(symbol="NYT")
         self.root = self.NYT
-        self.nodes = []
-        self.seen = [None for _ in range(256)]
+        # nodes[order] is the node with that implicit number, the root gets
+        # the highest one and newly created nodes take the next lower ones
+        self.nodes = [None] * MAX_NODES
+        self.next_order = MAX_NODES - 1
+        # highest numbered node of every weight (the leader of its block)
+        self.leaders = {}
+        self.seen = [None for _ in range(MAX_SYMBOLS)]
+        self.tables = False
+
+    def get_code(self, node):
+        code = 0
+        length = 0
+        while node.parent is not None:
+            if node.parent.right is node:
+                code |= 1 << length
+            length += 1
+            node = node.parent
 
-    def get_code(self, s, node, code=''):
-        if node.left is None and node.right is None:
-            return code if node.symbol == s else ''
-        else:
-            tmp = ''
-            if node.left is not None:
-                tmp = self.get_code(s, node.left, code+'0')
-            if not tmp and node.right is not None:
-                tmp = self.get_code(s, node.right, code+'1')
+        return code, length
 
-            return tmp
+    def block(self, node):
+        return node.weight
 
     def find_largest_node(self, weight):
-        for n in reversed(self.nodes):
-            if n.weight == weight:
-                return n
+        return self.leaders[weight]
+
+    def add_node(self, node):
+        node.order = self.next_order
+        self.nodes[node.order] = node
+        self.next_order -= 1
+
+        self.join_block(node)
+
+    def join_block(self, node):
+        block = self.block(node)
+        leader = self.leaders.get(block)
+        if leader is None or leader.order < node.order:
+            self.leaders[block] = node
+
+    def leave_block(self, node):
+        block = self.block(node)
+        if self.leaders[block] is node:
+            below = self.nodes[node.order - 1] if node.order > 0 else None
+            if below is not None and self.block(below) == block:
+                self.leaders[block] = below
+            else:
+                del self.leaders[block]
+
+    def increment_weight(self, node):
+        self.leave_block(node)
+        node.weight += 1
+        self.join_block(node)
+
+    def forget_tables(self, node):
+        # the table of a node covers DECODE_BITS levels below it, so a change
+        # of children invalidates the tables of that many ancestors
+        if self.tables:
+            for _ in range(DECODE_BITS):
+                if node is None:
+                    break
+                node.table = None
+                node = node.parent
 
     def swap_node(self, n1, n2):
-        i1, i2 = self.nodes.index(n1), self.nodes.index(n2)
-        self.nodes[i1], self.nodes[i2] = self.nodes[i2], self.nodes[i1]
+        n1.order, n2.order = n2.order, n1.order
+        self.nodes[n1.order], self.nodes[n2.order] = n1, n2
+
+        if self.leaders[n1.weight] is n2:
+            self.leaders[n1.weight] = n1
+        elif self.leaders[n2.weight] is n1:
+            self.leaders[n2.weight] = n2
 
         n1.parent, n2.parent = n2.parent, n1.parent
 
@@ -52,8 +118,11 @@ class AdaptiveHuffman:
         else:
             n2.parent.right = n2
 
+        self.forget_tables(n1.parent)
+        self.forget_tables(n2.parent)
+
     def insert(self, s):
-        node = self.seen[ord(s)]
+        node = self.seen[s]
 
         if node is None:
             new = Node(symbol=s, weight=1)
@@ -63,13 +132,14 @@ class AdaptiveHuffman:
 
             if internal.parent is not None:
                 internal.parent.left = internal
+                self.forget_tables(internal.parent)
             else:
                 self.root = internal
 
-            self.nodes.insert(0, internal)
-            self.nodes.insert(0, new)
+            self.add_node(internal)
+            self.add_node(new)
 
-            self.seen[ord(s)] = new
+            self.seen[s] = new
             node = internal.parent
 
         while node is not None:
@@ -78,131 +148,316 @@ class AdaptiveHuffman:
             if node is not largest and node is not largest.parent and largest is not node.parent:
                 self.swap_node(node, largest)
 
-            node.weight += 1
+            self.increment_weight(node)
             node = node.parent
 
 
-    def encode(self, text):
-        result = ''
+    def encode(self, data, writer=None):
+        if writer is None:
+            writer = BitWriter()
 
-        for s in text:
-            if self.seen[ord(s)]:
-                result += self.get_code(s, self.root)
+        for s in data:
+            node = self.seen[s]
+            if node:
+                writer.write_bits(*self.get_code(node))
             else:
-                result += self.get_code('NYT', self.root)
-                result += bin(ord(s))[2:].zfill(8)
-                
+                writer.write_bits(*self.get_code(self.NYT))
+                writer.write_bits(s, 8)
+
             self.insert(s)
 
-        return result
+        return writer
+
+    def encode_chunks(self, chunks, writer):
+        for chunk in chunks:
+            self.encode(chunk, writer)
+            yield writer.pop_bytes()
 
-    def get_ascii_symbol(self, binary_string):
-        return chr(int(binary_string, 2))
+    def read_symbol(self, reader):
+        return reader.read_bits(8)
 
-    def decode(self, text):
-        result = ''
+    def walk(self, node, bits):
+        for i in range(DECODE_BITS - 1, -1, -1):
+            node = node.right if (bits >> i) & 1 else node.left
+            if node.left is None:
+                return node, DECODE_BITS - i
 
-        symbol = self.get_ascii_symbol(text[:8])
-        result += symbol
+        return node, DECODE_BITS
+
+    def walk_table(self, node, reader):
+        bits = reader.peek_bits(DECODE_BITS)
+
+        if node.table is None:
+            node.table = {}
+
+        entry = node.table.get(bits)
+        if entry is None:
+            entry = node.table[bits] = self.walk(node, bits)
+
+        node, used = entry
+        reader.skip_bits(used)
+
+        return node
+
+    def decode(self, reader):
+        return b''.join(self.decode_chunks(reader))
+
+    def decode_chunks(self, reader, chunk_size=CHUNK_SIZE):
+        # an empty input leaves nothing but the padding length
+        if reader.remaining == 0:
+            return
+
+        self.tables = True
+        result = bytearray()
+
+        symbol = self.read_symbol(reader)
+        result.append(symbol)
 
         self.insert(symbol)
         node = self.root
 
-        i = 8
-        while i < len(text):
-            node = node.left if text[i] == '0' else node.right
-            symbol = node.symbol
+        while True:
+            remaining = reader.remaining
+            if remaining >= DECODE_BITS:
+                node = self.walk_table(node, reader)
+            elif remaining > 0:
+                node = node.right if reader.read_bit() else node.left
+            else:
+                break
 
-            if symbol:
-                if symbol == 'NYT':
-                    symbol = self.get_ascii_symbol(text[i+1:i+9])
-                    i += 8
+            if node.left is None:
+                if node is self.NYT:
+                    symbol = self.read_symbol(reader)
+                else:
+                    symbol = node.symbol
 
-                result += symbol
+                result.append(symbol)
                 self.insert(symbol)
                 node = self.root
 
-            i += 1
+                if len(result) >= chunk_size:
+                    yield bytes(result)
+                    result = bytearray()
+
+        yield bytes(result)
+
+
+class VitterAdaptiveHuffman(AdaptiveHuffman):
+    """Vitter's algorithm: leaves precede internal nodes of the same weight."""
+
+    def block(self, node):
+        return node.weight, node.left is not None
+
+    def next_block(self, node):
+        if node.left is None:
+            return node.weight, True
+        else:
+            return node.weight + 1, False
+
+    def exchange(self, n1, n2):
+        p1, p2 = n1.parent, n2.parent
+
+        if p1 is p2:
+            p1.left, p1.right = p1.right, p1.left
+        else:
+            if p1.left is n1:
+                p1.left = n2
+            else:
+                p1.right = n2
+
+            if p2.left is n2:
+                p2.left = n1
+            else:
+                p2.right = n1
+
+            n1.parent, n2.parent = p2, p1
+
+        self.forget_tables(p1)
+        self.forget_tables(p2)
+
+        n1.order, n2.order = n2.order, n1.order
+        self.nodes[n1.order], self.nodes[n2.order] = n1, n2
+
+    def slide(self, node, leader):
+        # the node takes the place of the leader of the next block and every
+        # other node of that block moves one place down
+        first, last = node.order, leader.order
+        places = [(n.parent, n.parent.left is n) for n in self.nodes[first:last + 1]]
+        moved = self.nodes[first + 1:last + 1] + [node]
+
+        for order, (n, (parent, is_left)) in enumerate(zip(moved, places), first):
+            n.order = order
+            self.nodes[order] = n
+            n.parent = parent
+
+            if is_left:
+                parent.left = n
+            else:
+                parent.right = n
+
+            self.forget_tables(parent)
 
-        return result
+    def slide_and_increment(self, node):
+        parent = node.parent
+        self.leave_block(node)
+
+        next_block = self.next_block(node)
+        leader = self.leaders.get(next_block)
+        if leader is not None:
+            self.slide(node, leader)
+            self.leaders[next_block] = self.nodes[node.order - 1]
+
+        node.weight += 1
+        self.join_block(node)
+
+        return node.parent if node.left is None else parent
+
+    def insert(self, s):
+        node = self.seen[s]
+        leaf_to_increment = None
+
+        if node is None:
+            new = Node(symbol=s)
+            internal = Node(parent=self.NYT.parent, left=self.NYT, right=new)
+            new.parent = internal
+            self.NYT.parent = internal
+
+            if internal.parent is not None:
+                internal.parent.left = internal
+                self.forget_tables(internal.parent)
+            else:
+                self.root = internal
+
+            self.add_node(internal)
+            self.add_node(new)
+
+            self.seen[s] = new
+            leaf_to_increment = new
+            node = internal
+        else:
+            leader = self.leaders[self.block(node)]
+            if leader is not node:
+                self.exchange(node, leader)
+                self.leaders[self.block(node)] = node
+
+            if node.parent is self.NYT.parent:
+                leaf_to_increment = node
+                node = node.parent
+
+        while node is not None:
+            node = self.slide_and_increment(node)
+
+        if leaf_to_increment is not None:
+            self.slide_and_increment(leaf_to_increment)
+
+
+ALGORITHMS = {
+    'fgk': AdaptiveHuffman,
+    'vitter': VitterAdaptiveHuffman,
+}
 
 
 def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-e', '--encode', dest='encode', action='store_true', default=True)
     parser.add_argument('-d', '--decode', dest='encode', action='store_false')
+    parser.add_argument('--algorithm', dest='algorithm', choices=ALGORITHMS.keys(), default='fgk')
+    parser.add_argument('-b', '--binary', dest='binary', action='store_true', default=False)
+    parser.add_argument('--verify', dest='verify', action='store_true', default=False,
+                        help='only check the checksums of an encoded file')
     parser.add_argument('input_file')
-    parser.add_argument('output_file')
+    parser.add_argument('output_file', nargs='?')
 
     return parser
 
-def write_bits(bits, file):
-    with open(file, 'wb') as f:
-        for i in range(0, len(bits), 8):
-            f.write(int(bits[i:i+8].zfill(8), 2).to_bytes(1, 'big'))
+def count_chars(string, char_occurences):
+    char_occurences.update(string)
+
+    return string
+
 
 def entropy(string):
-    char_occurences = defaultdict(int)
-    for char in string:
-        char_occurences[char] += 1
+    return counts_entropy(Counter(string))
+
 
+def counts_entropy(char_occurences):
     result = 0
     for char, count in char_occurences.items():
         result += count * log(count, 2)
 
-    char_count = len(string)
+    char_count = sum(char_occurences.values())
 
     return log(char_count, 2) - (result / char_count)
 
-def write_bits(bits, file):
-    padding = (8 - ((len(bits) + 3) % 8)) % 8
-    output = bin(padding)[2:].zfill(3) + bits + padding*'0'
-    bytes_arr = bytes(int(output[i:i+8], 2) for i in range(0, len(output), 8))
-
-    with open(file, 'wb') as f:
-        f.write(bytes_arr)
-
-
-def read_bits(file):
-    with open(file, 'rb') as f:
-        bits = ''.join(bin(byte)[2:].zfill(8) for byte in f.read())
-    padding_len = int(bits[:3], 2)
-
-    if padding_len == 0:
-        return bits[3:]
-    else:
-        return bits[3:-padding_len]
-
 
 def main():
     args = get_arg_parser().parse_args()
 
+    if args.verify:
+        report_verification(args.input_file, 'huffman')
+        return
 
-    if args.encode:
-        with open(args.input_file) as f:
-            text = f.read()
-
-        result = AdaptiveHuffman().encode(text)
+    if args.output_file is None:
+        get_arg_parser().error('an output file is needed for coding')
 
-        print('Entropy:', entropy(text))
-        print('Average length:', len(result) / len(text))
-        print('Compression ratio:', len(text) * 8 / len(result))
-
-        write_bits(result, args.output_file)
+    if args.encode:
+        char_occurences = Counter()
+        result = start_bits()
+
+        with ExitStack() as stack:
+            if args.binary and args.input_file == '-':
+                # the standard input cannot be mapped, stream it instead
+                chunks = read_chunks(stack.enter_context(open_input(args.input_file, 'rb')))
+            elif args.binary:
+                chunks = view_chunks(stack.enter_context(map_input(args.input_file)))
+            else:
+                # text mode maps characters to bytes one to one, so only the
+                # first 256 code points can be encoded
+                f = stack.enter_context(open_input(args.input_file))
+                chunks = (chunk.encode('latin-1') for chunk in read_chunks(f))
+            chunks = (count_chars(chunk, char_occurences) for chunk in chunks)
+            out = stack.enter_context(open_patchable_output(args.output_file))
+
+            params = {'algorithm': args.algorithm, 'binary': args.binary}
+            container = ContainerWriter(out, 'huffman', json.dumps(params).encode())
+            container.begin_block()
+            write_bits(result, ALGORITHMS[args.algorithm]().encode_chunks(chunks, result), out)
+            container.end_block(sum(char_occurences.values()))
+            container.close()
+
+        length = len(result) - 3
+        char_count = sum(char_occurences.values())
+        if char_count == 0:
+            return
+
+        # keep the statistics out of the encoded data written to stdout
+        log_file = sys.stderr if args.output_file == '-' else sys.stdout
+
+        print('Entropy:', counts_entropy(char_occurences), file=log_file)
+        print('Average length:', length / char_count, file=log_file)
+        print('Compression ratio:', char_count * 8 / length, file=log_file)
     else:
-        text = read_bits(args.input_file)
-        print(text)
-        result = AdaptiveHuffman().decode(text)
+        with ExitStack() as stack:
+            # the block index sits at the end of the container, so decoding
+            # from the standard input has to buffer all of it first
+            data = stack.enter_context(map_input(args.input_file))
+            if is_container(data):
+                container = ContainerReader(data)
+                container.check_codec('huffman')
+                # the settings used for encoding win over --algorithm and -b
+                params = json.loads(container.params)
+                algorithm = params['algorithm']
+                binary = params.get('binary', args.binary)
+                bits = read_bits(container.read_block(0))
+            else:
+                algorithm = args.algorithm
+                binary = args.binary
+                bits = read_bits(data)
 
-        with open(args.output_file, 'w') as f:
-            f.write(result)
+            out = stack.enter_context(open_output(args.output_file, 'wb' if binary else 'w'))
+            for piece in ALGORITHMS[algorithm]().decode_chunks(bits):
+                out.write(piece if binary else piece.decode('latin-1'))
 
 
 if __name__ == "__main__":
     main()
-        
-
-
-    
-
-        
\ No newline at end of file
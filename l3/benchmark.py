@@ -0,0 +1,118 @@
+import os
+import sys
+from time import perf_counter
+
+from main import EliasDelta, EliasGamma, EliasOmega, Encoding, Fibonacci
+from common.bits import BitReader, BitWriter
+
+
+DEFAULT_INPUT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', 'l1', 'tests', 'pan-tadeusz-czyli-ostatni-zajazd-na-litwie.txt'
+)
+
+CODERS = [
+    ('gamma', EliasGamma),
+    ('delta', EliasDelta),
+    ('omega', EliasOmega),
+    ('fibonacci', Fibonacci),
+]
+
+
+def encode_bit_string(coder, codes):
+    """Builds a '0'/'1' string first, the way the coders used to."""
+    bits = ''.join(format(value, f'0{n}b') for value, n in map(coder.code, codes))
+    bits += '0' * (-len(bits) % 8)
+
+    return bytes(int(bits[i:i+8], 2) for i in range(0, len(bits), 8))
+
+
+def encode_one_by_one(coder, codes):
+    writer = BitWriter()
+    for num in codes:
+        coder.encode(num, writer)
+
+    return writer.getvalue()
+
+
+def decode_generator(coder, data):
+    return list(coder.decode(BitReader(data)))
+
+
+def decode_without_table(coder, data):
+    """Reads every code with decode_one, without the lookup table."""
+    reader = BitReader(data)
+    codes = []
+    while (num := coder.decode_one(reader)) is not None:
+        codes.append(num)
+
+    return codes
+
+
+def decode_fibonacci_bitwise(coder, data):
+    """Reads Fibonacci codes one bit at a time, the way they used to be."""
+    reader = BitReader(data)
+    codes = []
+    while (num := coder._decode_long(reader)) is not None:
+        codes.append(num)
+
+    return codes
+
+
+def measure(function, *args):
+    start = perf_counter()
+    result = function(*args)
+
+    return result, perf_counter() - start
+
+
+def benchmark(codes):
+    millions = len(codes) / 10**6
+
+    for name, coder_class in CODERS:
+        print(name)
+
+        encoders = [
+            ('bit string', encode_bit_string),
+            ('write_bits', encode_one_by_one),
+            ('encode_many', lambda coder, codes: coder.encode_many(codes)),
+        ]
+        for label, encoder in encoders:
+            data, seconds = measure(encoder, coder_class(), codes)
+            print(f'  encode {label}: {millions / seconds:.2f} M codes/s')
+
+        # the lookup table is built once per class, keep it out of the timings
+        coder_class().decode_table()
+
+        decoders = [
+            ('decode_one', decode_without_table),
+            ('decode', decode_generator),
+            ('decode_many', lambda coder, data: coder.decode_many(data)),
+        ]
+        if coder_class is Fibonacci:
+            decoders.insert(0, ('bitwise', decode_fibonacci_bitwise))
+        for label, decoder in decoders:
+            decoded, seconds = measure(decoder, coder_class(), data)
+            assert list(decoded) == codes
+            print(f'  decode {label}: {millions / seconds:.2f} M codes/s')
+
+
+def main():
+    file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INPUT
+
+    with open(file, 'rb') as f:
+        data = f.read()
+
+    # LZW codes of a long text are mostly longer than the lookup table,
+    # the bytes themselves (shifted past omega's end marker) fit in it
+    codes = list(Encoding(None).lzw_encode(data.decode('latin-1')))
+    print(f'{file}: {len(codes)} LZW codes')
+    benchmark(codes)
+
+    codes = [byte + 2 for byte in data]
+    print(f'{file}: {len(codes)} bytes')
+    benchmark(codes)
+
+
+if __name__ == "__main__":
+    main()
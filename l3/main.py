@@ -1,156 +1,523 @@
 import argparse
-from itertools import chain
+import json
+import os
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import chain, islice
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.arguments import positive_int
+from common.bits import BitReader, BitWriter, finish_bits, read_bits, start_bits, write_bits
+from common.container import ContainerReader, ContainerWriter, is_container, report_verification
+from common.parallel import ordered_map
+from common.streams import CHUNK_SIZE, map_input, open_input, open_output, open_patchable_output, read_chunks
 
-class EliasGamma:
-    def encode(self, num: int):
-        binary = bin(num)[2:]
-        return (len(binary)-1) * '0' + binary
 
-    def decode(self, bits):
-        while bits != "":
-            zeros_count = 0
-            while bits[zeros_count] == '0':
-                zeros_count += 1
-                if zeros_count >= len(bits):
-                    return
+# Fibonacci numbers used by the Zeckendorf representation, F(2) onwards
+FIBONACCI = [1, 2]
+while FIBONACCI[-1] < 1 << 64:
+    FIBONACCI.append(FIBONACCI[-1] + FIBONACCI[-2])
+
+# ZECKENDORF_BYTES[i][byte] is the value of the bits of byte when they are
+# bits 8i to 8i + 7 of a Fibonacci code
+ZECKENDORF_BYTES = [
+    [sum(FIBONACCI[8 * i + bit] for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+    for i in range(8)
+]
+
+# number of bits resolved with a single lookup while decoding
+DECODE_BITS = 16
+
+# Elias codes are decoded from a window of bits kept as an integer, topped
+# up by WINDOW_BITS bits once it has fewer than REFILL_BITS, which holds
+# the longest code of a 64-bit number
+WINDOW_BITS = 256
+REFILL_BITS = 128
+
+
+class UniversalCode:
+    def code(self, num):
+        """Returns the code of num as an integer and its length in bits."""
+        raise NotImplementedError
+
+    def encode(self, num: int, writer):
+        writer.write_bits(*self.code(num))
+
+    # smallest number a stream can hold, as decode has to tell it apart
+    # from the end of the stream
+    smallest = 1
+
+    def encode_many(self, nums):
+        nums = list(nums)
+        if nums and min(nums) < self.smallest:
+            raise ValueError(f'{type(self).__name__} only encodes numbers from {self.smallest}')
+
+        writer = BitWriter()
+        writer.write_codes(map(self.code, nums))
+
+        return writer.getvalue()
+
+    def decode_many(self, data):
+        """Returns the numbers as an array, or as a list if some do not fit
+        in 64 bits."""
+        nums = list(self.decode(BitReader(data)))
+
+        try:
+            return array('Q', nums)
+        except OverflowError:
+            return nums
+
+    def decode_one(self, reader):
+        """Reads a single number, returns None at the end of the stream."""
+        raise NotImplementedError
+
+    def decode(self, reader):
+        """Yields the numbers up to the end of the stream.
+
+        Subclasses read them from a window of bits kept as an integer,
+        see fill_window.
+        """
+        while (num := self.decode_one(reader)) is not None:
+            yield num
+
+    def decode_table(self):
+        """Maps every DECODE_BITS bit window to the number its code starts
+        with and the code length. Windows that only hold the start of a
+        code map to what prefix_entry makes of them."""
+        cls = type(self)
+        if cls.__dict__.get('_decode_table') is None:
+            table = [self.prefix_entry(window) for window in range(1 << DECODE_BITS)]
+
+            num = self.first_tabled
+            value, length = self.code(num)
+            while length <= DECODE_BITS:
+                shift = DECODE_BITS - length
+                table[value << shift:(value + 1) << shift] = [(num, length)] * (1 << shift)
+
+                num += 1
+                value, length = self.code(num)
+
+            cls._decode_table = table
+
+        return cls._decode_table
+
+    # smallest number whose code is put in the decoding table
+    first_tabled = 1
+
+    def prefix_entry(self, window):
+        """Returns (-state, length) for a window starting with length bits
+        of a longer code, which leave decoding in state, or None."""
+        return None
+
+
+def fill_window(reader, window, bits, needed=REFILL_BITS):
+    """Appends the next bits of reader to a window of bits until it has
+    needed bits or the stream ends, returns the window and its length."""
+    while bits < needed and reader.remaining > 0:
+        value, n = reader.take_bits(WINDOW_BITS)
+        window = (window << n) | value
+        bits += n
+
+    return window, bits
+
+
+class EliasGamma(UniversalCode):
+    def code(self, num):
+        return num, 2 * num.bit_length() - 1
+
+    def decode_one(self, reader):
+        zeros_count = reader.read_zeros()
+        if zeros_count is None:
+            return None
 
-            yield int(bits[:2*zeros_count+1], base=2)
-            bits = bits[2*zeros_count+1:]
+        return reader.read_bits(zeros_count + 1)
 
+    def decode(self, reader):
+        # the zeros before the first 1 give the length right away, so
+        # there is nothing for a lookup table to save
+        window = bits = 0
 
-class EliasDelta:
-    def encode(self, num: int):
-        binary = bin(num)[2:]
-        n = EliasGamma().encode(len(binary))
+        while True:
+            if bits < REFILL_BITS:
+                window, bits = fill_window(reader, window, bits)
 
-        return n + binary[1:]
+            while not window and reader.remaining > 0:
+                window, bits = fill_window(reader, window, bits, bits + 1)
+            if not window:
+                return
+
+            length = 2 * (bits - window.bit_length()) + 1
+            if length > bits:
+                window, bits = fill_window(reader, window, bits, length)
+                if length > bits:
+                    raise EOFError('no more bits to read')
+
+            bits -= length
+            yield window >> bits
+            window &= (1 << bits) - 1
+
+
+class EliasDelta(UniversalCode):
+    def code(self, num):
+        length = num.bit_length()
+        length_bits = length.bit_length()
+        rest = length - 1
+
+        return (length << rest) | (num & ((1 << rest) - 1)), 2 * length_bits - 1 + rest
+
+    def decode_one(self, reader):
+        zeros_count = reader.read_zeros()
+        if zeros_count is None:
+            return None
+
+        n = reader.read_bits(zeros_count + 1)
+
+        return (1 << (n - 1)) | reader.read_bits(n - 1)
+
+    def prefix_entry(self, window):
+        # the gamma coded length of the number, when it fits
+        if not window:
+            return None
+
+        length_bits = 2 * (DECODE_BITS - window.bit_length()) + 1
+        if length_bits > DECODE_BITS:
+            return None
+
+        return -(window >> (DECODE_BITS - length_bits)), length_bits
+
+    def decode(self, reader):
+        table = self.decode_table()
+        window = bits = 0
+
+        while True:
+            if bits < REFILL_BITS:
+                window, bits = fill_window(reader, window, bits)
 
-    def decode(self, bits):
-        while bits != "":
-            zeros_count = 0
-            while bits[zeros_count] == '0':
-                zeros_count += 1
-                if zeros_count >= len(bits):
+            entry = table[window >> (bits - DECODE_BITS)] if bits >= DECODE_BITS else None
+            if entry is not None:
+                num, length = entry
+                bits -= length
+                window &= (1 << bits) - 1
+
+                if num > 0:
+                    yield num
+                    continue
+                n = -num
+            else:
+                while not window and reader.remaining > 0:
+                    window, bits = fill_window(reader, window, bits, bits + 1)
+                if not window:
                     return
 
-            n = int(bits[:2*zeros_count+1], base=2)
-            bits = bits[2*zeros_count+1:]
+                length = 2 * (bits - window.bit_length()) + 1
+                if length > bits:
+                    window, bits = fill_window(reader, window, bits, length)
+                    if length > bits:
+                        raise EOFError('no more bits to read')
+
+                bits -= length
+                n = window >> bits
+                window &= (1 << bits) - 1
+
+            if n - 1 > bits:
+                window, bits = fill_window(reader, window, bits, n - 1)
+                if n - 1 > bits:
+                    raise EOFError('no more bits to read')
 
-            yield int('1' + bits[:n-1], base=2)
-            bits = bits[n-1:]
+            bits -= n - 1
+            yield (1 << (n - 1)) | (window >> bits)
+            window &= (1 << bits) - 1
 
 
-class EliasOmega:
-    def encode(self, num: int):
-        encoding = '0'
+class EliasOmega(UniversalCode):
+    def code(self, num):
+        # groups are prepended, the code ends with a single '0'
+        code = 0
+        length = 1
         k = num
 
         while k > 1:
-            binary_k = bin(k)[2:]
-            encoding = binary_k + encoding
-            k = len(binary_k) - 1
+            code |= k << length
+            length += k.bit_length()
+            k = k.bit_length() - 1
+
+        return code, length
+
+    # the code of 1 is '0', which the decoder takes for the end of the stream
+    smallest = 2
+    first_tabled = 2
+
+    def decode_one(self, reader):
+        # every group starts with a 1 and tells the length of the next,
+        # it is read together with the bit after it
+        n = 1
+        while True:
+            if reader.remaining < n + 2:
+                return None
+
+            group = reader.read_bits(n + 2)
+            if not group >> (n + 1):
+                return None
+
+            n = group >> 1
+            if not group & 1:
+                return n
+            reader.skip_bits(-1)
+
+    def prefix_entry(self, window):
+        # the leading groups that fit, with the length of the next group
+        n = 1
+        length = 0
+        while length + n + 2 <= DECODE_BITS:
+            group = (window >> (DECODE_BITS - length - n - 2)) & ((1 << (n + 2)) - 1)
+            if not group >> (n + 1) or not group & 1:
+                # the end of the stream, or a whole code, which the
+                # table holds already
+                return None
+
+            length += n + 1
+            n = group >> 1
+
+        return (-n, length) if length else None
+
+    def decode(self, reader):
+        table = self.decode_table()
+        window = bits = 0
+
+        while True:
+            if bits < REFILL_BITS:
+                window, bits = fill_window(reader, window, bits)
 
-        return encoding
-
-    def decode(self, bits):
-        while bits != "":
             n = 1
-            if bits[0] == '0':
-                return
-            while bits[0] != '0':
-                prev_n = n
-                n = int(bits[:n+1], base=2)
-                bits = bits[prev_n+1:]
-                if bits == "":
+            if bits >= DECODE_BITS:
+                entry = table[window >> (bits - DECODE_BITS)]
+                if entry is not None:
+                    num, length = entry
+                    bits -= length
+                    window &= (1 << bits) - 1
+
+                    if num > 0:
+                        yield num
+                        continue
+                    n = -num
+
+            # the groups left, as in decode_one
+            while True:
+                if bits < n + 2:
+                    window, bits = fill_window(reader, window, bits, n + 2)
+                    if bits < n + 2:
+                        return
+
+                group = window >> (bits - n - 2)
+                if not group >> (n + 1):
                     return
 
-            yield n
-            bits = bits[1:]
+                if group & 1:
+                    bits -= n + 1
+                else:
+                    bits -= n + 2
+                window &= (1 << bits) - 1
+
+                n = group >> 1
+                if not group & 1:
+                    yield n
+                    break
 
 
-class Fibonacci:
+class Fibonacci(UniversalCode):
+    # codes of all numbers below TABLE_SIZE, as (value, length) pairs
+    TABLE_SIZE = 1 << 16
+    _table = None
+
     def __init__(self):
-        self._sequence = [0, 1]
-        self._prev_max = 1
+        if Fibonacci._table is None:
+            Fibonacci._table = [(1, 1)]
+            for num in range(1, self.TABLE_SIZE):
+                Fibonacci._table.append(self._zeckendorf(num, Fibonacci._table))
 
     def _get_sequence(self, max_num):
-        if max_num > self._prev_max:
-            while self._sequence[-1] + self._sequence[-2] <= max_num:
-                self._sequence.append(self._sequence[-1] + self._sequence[-2])
-
-            self._prev_max = max_num
+        while FIBONACCI[-1] <= max_num:
+            FIBONACCI.append(FIBONACCI[-1] + FIBONACCI[-2])
 
-            return self._sequence.copy()
-        else:
-            return [num for num in self._sequence if num <= max_num]
+        return FIBONACCI
 
-    def encode(self, num):
+    def _zeckendorf(self, num, codes):
+        # num = F(top) + rest with rest < F(top - 1), so the code of num is
+        # the code of rest without its final '1', zeros up to F(top), '11'
         sequence = self._get_sequence(num)
-        result = '1'
+        top = bisect_right(sequence, num) - 1
+        rest = num - sequence[top]
+
+        rest_code, rest_length = codes[rest] if rest < len(codes) else self.code(rest)
+
+        return (((rest_code >> 1) << (top - rest_length + 1)) << 2) | 0b11, top + 2
+
+    def code(self, num):
+        if num < self.TABLE_SIZE:
+            return self._table[num]
+
+        return self._zeckendorf(num, self._table)
 
-        while num != 0:
-            num -= sequence[-1]
-            result = '1' + result
-            sequence.pop()
-            while sequence[-1] > num:
-                result = '0' + result
-                sequence.pop()
+    def _value(self, code, length):
+        """Returns the number of a code without its final '1'."""
+        if length > 64:
+            sequence = self._get_sequence(1 << length)
+            return sum(sequence[i] for i in range(length) if code >> (length - 1 - i) & 1)
 
-        return result[1:]
+        # left aligned to whole bytes
+        code <<= -length % 8
+        size = (length + 7) // 8
 
-    def decode(self, bits):
+        num = 0
+        for i in range(size):
+            num += ZECKENDORF_BYTES[i][(code >> (8 * (size - 1 - i))) & 0xff]
+
+        return num
+
+    def decode_one(self, reader):
+        n = min(reader.remaining, 64)
+        if n <= 0:
+            return None
+
+        window = reader.peek_bits(n)
+        # bit i of pairs is set where bits i + 1 and i of the window are
+        # both 1, the first such pair is the '11' that ends the code
+        pairs = window & (window >> 1)
+
+        if not pairs:
+            if n < 64:
+                reader.skip_bits(n)
+                return None
+
+            return self._decode_long(reader)
+
+        end = pairs.bit_length() - 1
+        reader.skip_bits(n - end)
+
+        return self._value(window >> (end + 1), n - end - 1)
+
+    def _decode_long(self, reader):
+        # codes longer than 64 bits are read one bit at a time
         cur_num = 0
-        prev_bit = ''
+        prev_bit = 0
         cur_fib = 1
         prev_fib = 1
 
-        for bit in bits:
-            if bit == prev_bit and prev_bit == '1':
-                yield cur_num
-                cur_num = 0
-                prev_bit = ''
-                cur_fib = 1
-                prev_fib = 1
+        while reader.remaining > 0:
+            bit = reader.read_bit()
+            if bit and prev_bit:
+                return cur_num
             else:
-                cur_num += int(bit) * cur_fib
+                cur_num += bit * cur_fib
                 prev_fib, cur_fib = cur_fib, cur_fib + prev_fib
                 prev_bit = bit
 
+        return None
+
+    def decode(self, reader):
+        table = self.decode_table()
+        window = bits = 0
+
+        while True:
+            if bits < REFILL_BITS:
+                window, bits = fill_window(reader, window, bits)
+
+            if bits >= DECODE_BITS:
+                entry = table[window >> (bits - DECODE_BITS)]
+                if entry is not None:
+                    bits -= entry[1]
+                    window &= (1 << bits) - 1
+                    yield entry[0]
+                    continue
+
+            # the first '11' ends the code, as in decode_one
+            pairs = window & (window >> 1)
+            while not pairs and reader.remaining > 0:
+                window, bits = fill_window(reader, window, bits, bits + 1)
+                pairs = window & (window >> 1)
+
+            if not pairs:
+                return
+
+            end = pairs.bit_length() - 1
+            num = self._value(window >> (end + 1), bits - end - 1)
+            bits = end
+            window &= (1 << bits) - 1
+            yield num
+
+
+NUMBER_ENCODERS = {
+    'omega': EliasOmega,
+    'gamma': EliasGamma,
+    'delta': EliasDelta,
+    'fibonacci': Fibonacci,
+}
+
+
+def unsupported_char(code):
+    return ValueError(f'cannot encode {chr(code)!r}, only the first 256 characters are supported')
+
 
 class Encoding:
-    def __init__(self, number_encoder):
+    def __init__(self, number_encoder, max_codes=None, full_policy='reset'):
         self.number_encoder = number_encoder
+        # once max_codes codes are in use the dictionary is either cleared
+        # ('reset') or left as it is ('freeze'), decoding has to use the same
+        self.max_codes = max_codes
+        self.full_policy = full_policy
 
-    def lzw_encode(self, string: str):
-        encoding_table = {chr(i): i for i in range(256)}
+    def lzw_encode(self, string):
+        # phrases are kept as a trie: (code of the phrase without its last
+        # character << 8 | last character) -> code of the phrase
+        encoding_table = {}
 
         next_num = 256
 
-        prev = string[0]
-        for char in string[1:]:
-            if (prev + char) in encoding_table:
-                prev += char
+        codes = map(ord, string)
+        prev = next(codes, None)
+        if prev is None:
+            return
+        if prev > 255:
+            raise unsupported_char(prev)
+
+        for char in codes:
+            if char > 255:
+                raise unsupported_char(char)
+
+            key = (prev << 8) | char
+            code = encoding_table.get(key)
+
+            if code is not None:
+                prev = code
             else:
-                yield encoding_table[prev]
+                yield prev
 
-                encoding_table[prev + char] = next_num
-                next_num += 1
+                if self.max_codes is None or next_num < self.max_codes:
+                    encoding_table[key] = next_num
+                    next_num += 1
+                elif self.full_policy == 'reset':
+                    encoding_table.clear()
+                    next_num = 256
 
                 prev = char
 
-        yield encoding_table[prev]
+        yield prev
 
     def lzw_decode(self, codes):
-        decoding_table = {i: chr(i) for i in range(256)}
-        next_num = 256
+        decoding_table = [chr(i) for i in range(256)]
+
+        codes = iter(codes)
+        old = next(codes, None)
+        if old is None:
+            return
 
-        old = codes[0]
         c = ""
         yield decoding_table[old]
 
-        for code in codes[1:]:
-            if code not in decoding_table:
+        for code in codes:
+            if code >= len(decoding_table):
                 s = decoding_table[old]
                 s += c
             else:
@@ -158,48 +525,98 @@ class Encoding:
 
             yield s
             c = s[0]
-            decoding_table[next_num] = decoding_table[old] + c
-            next_num += 1
+
+            if self.max_codes is None or len(decoding_table) < self.max_codes:
+                decoding_table.append(decoding_table[old] + c)
+            elif self.full_policy == 'reset':
+                del decoding_table[256:]
 
             old = code
 
-    def encode(self, string):
-        return ''.join(self.number_encoder.encode(num)
-                       for num in self.lzw_encode(string))
+    def encode(self, string, writer=None):
+        if writer is None:
+            writer = BitWriter()
 
-    def decode(self, bits):
-        return ''.join(self.lzw_decode(list(self.number_encoder.decode(bits))))
+        writer.write_codes(map(self.number_encoder.code, self.lzw_encode(string)))
 
+        return writer
 
-def write_bits(bits, file):
-    padding = (8 - ((len(bits) + 3) % 8)) % 8
-    output = bin(padding)[2:].zfill(3) + bits + padding*'0'
-    bytes_arr = bytes(int(output[i:i+8], 2) for i in range(0, len(output), 8))
+    def encode_chunks(self, chunks, writer):
+        codes = map(self.number_encoder.code, self.lzw_encode(chain.from_iterable(chunks)))
 
-    with open(file, 'wb') as f:
-        f.write(bytes_arr)
+        for batch in iter(lambda: list(islice(codes, CHUNK_SIZE)), []):
+            writer.write_codes(batch)
+            yield writer.pop_bytes()
 
+    def decode(self, reader):
+        return ''.join(self.decode_chunks(reader))
 
-def read_bits(file):
-    with open(file, 'rb') as f:
-        bits = ''.join(bin(byte)[2:].zfill(8) for byte in f.read())
-    padding_len = int(bits[:3], 2)
+    def decode_chunks(self, reader, chunk_size=CHUNK_SIZE):
+        result = []
+        length = 0
 
-    if padding_len == 0:
-        return bits[3:]
-    else:
-        return bits[3:-padding_len]
+        for s in self.lzw_decode(self.number_encoder.decode(reader)):
+            result.append(s)
+            length += len(s)
+
+            if length >= chunk_size:
+                yield ''.join(result)
+                result = []
+                length = 0
+
+        yield ''.join(result)
+
+
+def count_length(chunk, lengths):
+    lengths.append(len(chunk))
+
+    return chunk
+
+
+def get_encoding(encoding, max_codes, full_policy):
+    return Encoding(NUMBER_ENCODERS[encoding](), max_codes, full_policy)
+
+
+# blocks are coded on their own, each one in the format of a whole file,
+# the settings are the keyword arguments of get_encoding
+def encode_block(task):
+    settings, text = task
+
+    result = start_bits()
+    get_encoding(**settings).encode(text, result)
+
+    return finish_bits(result), len(text)
+
+
+def decode_block(task):
+    settings, data = task
+
+    return get_encoding(**settings).decode(read_bits(data))
 
 
 def get_arg_parser():
     parser = argparse.ArgumentParser()
+    # the coding settings are stored in the output, on decoding they only
+    # matter for files from before the container
     parser.add_argument('--encoding', dest='encoding',
                         choices=['omega', 'gamma', 'delta', 'fibonacci'], default='omega')
     parser.add_argument('-e', '--encode', dest='encode',
                         action='store_true', default=True)
     parser.add_argument('-d', '--decode', dest='encode', action='store_false')
+    parser.add_argument('--max-codes', dest='max_codes', type=positive_int, default=None,
+                        help='codes in the dictionary at most, above the 256 of single characters')
+    parser.add_argument('--full-policy', dest='full_policy',
+                        choices=['reset', 'freeze'], default='reset')
+    parser.add_argument('--block-size', dest='block_size', type=positive_int, default=None,
+                        help='code blocks of this many characters independently')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None,
+                        help='processes used for blocks, all cores by default')
+    parser.add_argument('--block', dest='block', type=int, default=None,
+                        help='decode only the block with this index')
+    parser.add_argument('--verify', dest='verify', action='store_true', default=False,
+                        help='only check the checksums of an encoded file')
     parser.add_argument('infile')
-    parser.add_argument('outfile')
+    parser.add_argument('outfile', nargs='?')
 
     return parser
 
@@ -207,33 +624,75 @@ def get_arg_parser():
 def main():
     args = get_arg_parser().parse_args()
 
-    if args.encoding == 'fibonacci':
-        number_encoder = Fibonacci()
-    elif args.encoding == 'gamma':
-        number_encoder = EliasGamma()
-    elif args.encoding == 'delta':
-        number_encoder = EliasDelta()
-    else:
-        number_encoder = EliasOmega()
+    if args.verify:
+        report_verification(args.infile, 'lzw')
+        return
+
+    if args.outfile is None:
+        get_arg_parser().error('an output file is needed for coding')
+    if args.max_codes is not None and args.max_codes <= 256:
+        get_arg_parser().error('--max-codes has to leave room above the 256 single characters')
+
+    settings = {
+        'encoding': args.encoding,
+        'max_codes': args.max_codes,
+        'full_policy': args.full_policy,
+    }
+
+    if args.encode and args.block_size is not None:
+        with open_input(args.infile) as f, open_output(args.outfile, 'wb') as out:
+            container = ContainerWriter(out, 'lzw', json.dumps(settings).encode())
+
+            blocks = iter(lambda: f.read(args.block_size), '')
+            tasks = ((settings, block) for block in blocks)
+            for payload, size in ordered_map(encode_block, tasks, args.jobs):
+                container.write_block(payload, size)
+
+            container.close()
+    elif args.encode:
+        result = start_bits()
 
-    encoding = Encoding(number_encoder)
+        with open_input(args.infile) as f, open_patchable_output(args.outfile) as out:
+            container = ContainerWriter(out, 'lzw', json.dumps(settings).encode())
+            container.begin_block()
 
-    if args.encode:
-        with open(args.infile, 'r') as f:
-            text = f.read()
-        result = encoding.encode(text)
+            lengths = []
+            chunks = (count_length(chunk, lengths) for chunk in read_chunks(f))
+            write_bits(result, get_encoding(**settings).encode_chunks(chunks, result), out)
 
-        # with open(args.outfile, 'w') as f:
-        #     f.write(result)
-        write_bits(result, args.outfile)
+            container.end_block(sum(lengths))
+            container.close()
     else:
-        # with open(args.infile, 'r') as f:
-        #     bits = f.read()
-        bits = read_bits(args.infile)
-        result = encoding.decode(bits)
+        with map_input(args.infile) as data, open_output(args.outfile) as out:
+            if not is_container(data):
+                bits = read_bits(data)
+                for piece in get_encoding(**settings).decode_chunks(bits):
+                    out.write(piece)
+                return
+
+            container = ContainerReader(data)
+            container.check_codec('lzw')
+            settings = json.loads(container.params)
+
+            if args.block is None and len(container) == 1:
+                # a whole file in one block is decoded straight from the mapping
+                bits = read_bits(container.read_block(0))
+                for piece in get_encoding(**settings).decode_chunks(bits):
+                    out.write(piece)
+                return
+
+            if args.block is not None:
+                if not 0 <= args.block < len(container):
+                    get_arg_parser().error(f'there is no block {args.block}, '
+                                           f'the file has {len(container)} blocks')
+                blocks = [container.read_block(args.block)]
+            else:
+                blocks = container.read_blocks()
 
-        with open(args.outfile, 'w') as f:
-            f.write(result)
+            # views of the mapping cannot be sent to other processes
+            tasks = ((settings, bytes(block)) for block in blocks)
+            for piece in ordered_map(decode_block, tasks, args.jobs):
+                out.write(piece)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from main import (analyse, channel_counts, jpeg_ls, loco_decode, loco_encode, prediction_schemes,
+                  residual_counts, select_tile_schemes)
+from common.streams import map_input
+from common.tga import load_tga
+
+
+# a 4K frame of gradients with some noise, used without an input file,
+# LOCO-I is timed on a smaller one
+DEFAULT_SIZE = (2160, 3840)
+LOCO_SIZE = (512, 512)
+
+
+def synthetic_image(height, width):
+    rows, columns = np.mgrid[0:height, 0:width]
+    noise = np.random.default_rng(0).integers(-8, 9, (height, width, 3))
+
+    image = np.stack([
+        columns * 255 // width,
+        rows * 255 // height,
+        (rows + columns) * 255 // (height + width),
+    ], axis=-1) + noise
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def whole_image_counts(bitmap):
+    """Predicts the whole image per scheme and counts the channels apart."""
+    return np.stack([channel_counts(jpeg_ls(bitmap, scheme)) for scheme in prediction_schemes])
+
+
+def measure(function, *args):
+    start = perf_counter()
+    result = function(*args)
+
+    return result, perf_counter() - start
+
+
+def benchmark(name, bitmap):
+    height, width, _ = bitmap.shape
+    megapixels = height * width / 10**6
+
+    print(f'{name}: {width}x{height}')
+
+    expected, seconds = measure(whole_image_counts, bitmap)
+    print(f'  whole image: {seconds:.3f} s, {megapixels / seconds:.1f} MP/s')
+
+    counts, seconds = measure(residual_counts, bitmap, prediction_schemes)
+    assert (counts == expected).all()
+    print(f'  bands of rows: {seconds:.3f} s, {megapixels / seconds:.1f} MP/s')
+
+    analysis, seconds = measure(analyse, bitmap)
+    assert (analysis.scheme_counts == expected).all()
+    print(f'  analyse, image counts included: {seconds:.3f} s, {megapixels / seconds:.1f} MP/s')
+
+    selection, seconds = measure(select_tile_schemes, bitmap)
+    print(f'  schemes per 64x64 tile: {seconds:.3f} s, {megapixels / seconds:.1f} MP/s,'
+          f' {selection.saved_bits():.0f} bits saved')
+
+
+def benchmark_loco(name, bitmap):
+    height, width, _ = bitmap.shape
+    megabytes = bitmap.size / 2**20
+
+    print(f'{name}: {width}x{height}, LOCO-I')
+
+    planes = [bitmap[..., c] for c in range(3)]
+
+    payloads, seconds = measure(lambda: [loco_encode(plane) for plane in planes])
+    length = sum(len(payload) for payload in payloads)
+    print(f'  {length * 8 / bitmap.size:.3f} bits per sample, encode {megabytes / seconds:.3f} MB/s')
+
+    decoded, seconds = measure(lambda: [loco_decode(payload, height, width) for payload in payloads])
+    assert all((plane == original).all() for plane, original in zip(decoded, planes))
+    print(f'  decode {megabytes / seconds:.3f} MB/s')
+
+
+def main():
+    if len(sys.argv) == 1:
+        benchmark('synthetic', synthetic_image(*DEFAULT_SIZE))
+        benchmark_loco('synthetic', synthetic_image(*LOCO_SIZE))
+
+    for file in sys.argv[1:]:
+        with map_input(file) as image:
+            bitmap, _, _ = load_tga(image)
+
+        benchmark(file, bitmap)
+        benchmark_loco(file, bitmap)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,185 +1,571 @@
-from sys import argv
-from collections import defaultdict
+import argparse
+import os
+import sys
 from math import log
+from time import perf_counter
 
+import numpy as np
 
-class Pixel:
-    def __init__(self, red=0, green=0, blue=0):
-        self.red = red
-        self.green = green
-        self.blue = blue
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-    def __repr__(self):
-        return f"{self.red} {self.green} {self.blue}"
+from common.arguments import positive_int
+from common.bits import BitReader, BitWriter
+from common.container import ContainerReader, ContainerWriter, is_container, report_verification
+from common.parallel import ordered_map
+from common.streams import map_input
+from common.tga import HEADER_SIZE, load_tga, tga_pixels
 
-    def __add__(self, other):
-        return Pixel(red=self.red+other.red, green=self.green+other.green, blue=self.blue+other.blue)
 
-    def __sub__(self, other):
-        return Pixel(red=self.red-other.red, green=self.green-other.green, blue=self.blue-other.blue)
+COLORS = {
+    'red': 0,
+    'green': 1,
+    'blue': 2,
+}
 
-    def __floordiv__(self, num):
-        return Pixel(red=self.red // num, green=self.green // num, blue=self.blue // num)
+# rows of the image predicted at once, few enough for the temporary
+# arrays to stay in the cache
+BAND_ROWS = 16
 
-    def __mod__(self, num):
-        return Pixel(
-            red=self.red % num,
-            green=self.green % num,
-            blue=self.blue % num
-        )
 
+def entropy(counts, color):
+    """Entropy of one channel or, for any other color, of all of them,
+    given the (3, 256) value counts of the channels."""
+    if color in COLORS:
+        occurences = counts[COLORS[color]]
+    else:
+        occurences = counts.sum(axis=0)
 
-def parse_bitmap(bitmap, width, height):
-    result = []
-    row = []
-    for i in range(width*height):
-        row.append(Pixel(
-            blue=bitmap[i*3],
-            green=bitmap[i*3+1],
-            red=bitmap[i*3+2],
-        ))
+    occurences = occurences[occurences > 0]
+    count = int(occurences.sum())
 
-        if len(row) == width:
-            result.insert(0, row)
-            row = []
+    result = float((occurences * np.log2(occurences)).sum())
 
-    return result
+    return log(count, 2) - (result / count)
 
 
-def entropy(bitmap, color):
-    occurences = defaultdict(int)
-    count = 0
-    for row in bitmap:
-        for pixel in row:
-            if color == 'red':
-                occurences[pixel.red] += 1
-                count += 1
-            elif color == 'green':
-                occurences[pixel.green] += 1
-                count += 1
-            elif color == 'blue':
-                occurences[pixel.blue] += 1
-                count += 1
-            else:
-                occurences[pixel.red] += 1
-                occurences[pixel.green] += 1
-                occurences[pixel.blue] += 1
-                count += 3
+def channel_counts(bitmap):
+    return np.stack([np.bincount(bitmap[..., c].reshape(-1), minlength=256) for c in range(3)])
 
-    result = 0
-    for val, c in occurences.items():
-        result += c * log(c, 2)
 
-    return log(count, 2) - (result / count)
+def padded_pixels(bitmap):
+    """Returns the pixels as int16 below a black row and right of a black
+    column, which stand for the neighbours outside the image."""
+    height, width, _ = bitmap.shape
+
+    padded = np.zeros((height + 1, width + 1, 3), dtype=np.int16)
+    padded[1:, 1:] = bitmap
+
+    return padded
+
+
+def residuals(rows, prediction_scheme):
+    """Returns the residuals modulo 256 of rows[1:, 1:] of padded pixels."""
+    north = rows[:-1, 1:]
+    west = rows[1:, :-1]
+    north_west = rows[:-1, :-1]
+
+    result = rows[1:, 1:] - prediction_scheme(north, west, north_west)
+    result &= 255
+
+    return result
 
 
 def jpeg_ls(bitmap, prediction_scheme):
-    empty = Pixel(red=0, green=0, blue=0)
-    result = []
-    for i, row in enumerate(bitmap):
-        enc_row = []
-        for j, pixel in enumerate(row):
-            if i == 0:
-                north = empty
-            else:
-                north = bitmap[i-1][j]
+    return residuals(padded_pixels(bitmap), prediction_scheme).astype(np.uint8)
 
-            if j == 0:
-                west = empty
-            else:
-                west = bitmap[i][j-1]
 
-            if i == 0 or j == 0:
-                north_west = empty
-            else:
-                north_west = bitmap[i-1][j-1]
+def residual_counts(bitmap, schemes):
+    """Returns the (3, 256) value counts of the residuals of every scheme,
+    predicting the image a band of rows at a time."""
+    padded = padded_pixels(bitmap)
+    # the channel of every residual goes into its high bits, so that one
+    # bincount covers all three
+    channels = np.array([0, 256, 512], dtype=np.int16)
 
-            encoding = (pixel - prediction_scheme(north,
-                                                  west, north_west)) % 256
-            enc_row.append(encoding)
+    counts = np.zeros((len(schemes), 3 * 256), dtype=np.int64)
+    for top in range(0, len(padded) - 1, BAND_ROWS):
+        rows = padded[top:top + BAND_ROWS + 1]
 
-        result.append(enc_row)
+        for i, scheme in enumerate(schemes):
+            values = residuals(rows, scheme)
+            values += channels
+            counts[i] += np.bincount(values.reshape(-1), minlength=3 * 256)
 
-    return result
+    return counts.reshape(len(schemes), 3, 256)
 
 def new_standard(n, w, nw):
-    if nw >= max(w, n):
-        return min(w, n)
-    elif nw <= min(w, n):
-        return max(w, n)
-    else:
-        return w+n-nw
+    # w+n-nw clipped to the range of w and n is min(w, n) when nw is
+    # above it, max(w, n) when nw is below it and w+n-nw otherwise
+    return np.clip(w+n-nw, np.minimum(w, n), np.maximum(w, n))
 
+# x >> 1 is x // 2, only faster on arrays
 prediction_schemes = [
     lambda n, w, nw: w,
     lambda n, w, nw: n,
     lambda n, w, nw: nw,
     lambda n, w, nw: n+w-nw,
-    lambda n, w, nw: n+(w-nw)//2,
-    lambda n, w, nw: w+(n-nw)//2,
-    lambda n, w, nw: (n+w)//2,
-    lambda n, w, nw: Pixel(red=new_standard(n.red, w.red, nw.red), green=new_standard(n.green, w.green, nw.green), blue=new_standard(n.blue, w.blue, nw.blue))
+    lambda n, w, nw: n+((w-nw) >> 1),
+    lambda n, w, nw: w+((n-nw) >> 1),
+    lambda n, w, nw: (n+w) >> 1,
+    new_standard,
 ]
 
 
 
-def main():
-    file = argv[1]
+class Analysis:
+    """Value counts of an image and of the residuals of every prediction
+    scheme, the entropies are computed from them when asked for.
+
+    Schemes are numbered from 1 and the color is one of COLORS, anything
+    else stands for all channels together.
+    """
+
+    def __init__(self, image_counts, scheme_counts):
+        self.image_counts = image_counts
+        self.scheme_counts = scheme_counts
+
+    def __len__(self):
+        return len(self.scheme_counts)
+
+    def image_entropy(self, color=''):
+        return entropy(self.image_counts, color)
+
+    def scheme_entropy(self, scheme, color=''):
+        return entropy(self.scheme_counts[scheme - 1], color)
 
-    with open(file, 'rb') as f:
-        image = f.read()
+    def best_scheme(self, color=''):
+        entropies = [entropy(counts, color) for counts in self.scheme_counts]
 
-    width = image[13]*256 + image[12]
-    height = image[15]*256 + image[14]
+        return entropies.index(min(entropies)) + 1
 
-    bitmap = parse_bitmap(image[18:-26], width, height)
 
+def analyse(bitmap, schemes=prediction_schemes):
+    # predicting every pixel as 0 leaves the image itself, so its counts
+    # come from the same pass over the image as the ones of the schemes
+    counts = residual_counts(bitmap, [lambda n, w, nw: 0] + list(schemes))
+
+    return Analysis(counts[0], counts[1:])
+
+
+def print_analysis(analysis):
     print('Image entropy')
-    print(f"General: {entropy(bitmap, '')}")
-    print(f"Red: {entropy(bitmap, 'red')}")
-    print(f"Green: {entropy(bitmap, 'green')}")
-    print(f"Blue: {entropy(bitmap, 'blue')}")
+    print(f"General: {analysis.image_entropy()}")
+    print(f"Red: {analysis.image_entropy('red')}")
+    print(f"Green: {analysis.image_entropy('green')}")
+    print(f"Blue: {analysis.image_entropy('blue')}")
     print('---')
-    
-    best_general = 100 
-    best_red = 100
-    best_green = 100
-    best_blue = 100
-
-    for i, scheme in enumerate(prediction_schemes, 1):
-        encoded = jpeg_ls(bitmap, scheme)
+
+    for i in range(1, len(analysis) + 1):
         print(f"Scheme {i}")
-        general = entropy(encoded, '')
-        print(f"General: {general}")
-        red = entropy(encoded, 'red')
-        print(f"Red: {red}")
-        green = entropy(encoded, 'green')
-        print(f"Green: {green}")
-        blue = entropy(encoded, 'blue')
-        print(f"Blue: {blue}")
+        print(f"General: {analysis.scheme_entropy(i)}")
+        print(f"Red: {analysis.scheme_entropy(i, 'red')}")
+        print(f"Green: {analysis.scheme_entropy(i, 'green')}")
+        print(f"Blue: {analysis.scheme_entropy(i, 'blue')}")
         print('---')
 
-        if general < best_general:
-            best_general = general
-            best_general_no = i
+    print(f'Best general: {analysis.best_scheme()}')
+    print(f"Best red: {analysis.best_scheme('red')}")
+    print(f"Best green: {analysis.best_scheme('green')}")
+    print(f"Best blue: {analysis.best_scheme('blue')}")
 
-        if red < best_red:
-            best_red = red
-            best_red_no = i
 
-        if green < best_green:
-            best_green = green
-            best_green_no = i
+def coding_bits(counts):
+    """Bits needed by an ideal static code for the values counted along
+    the last axis of counts."""
+    n = counts.sum(axis=-1)
+    # x log x, with 0 for x = 0
+    n_log_n = n * np.log2(np.maximum(n, 1))
+
+    return n_log_n - (counts * np.log2(np.maximum(counts, 1))).sum(axis=-1)
+
+
+def tile_row_bits(task):
+    """Returns the bits of every scheme for the tiles of one row of tiles,
+    as a (schemes, tiles, 3) array, given the rows of padded pixels of the
+    row of tiles and the one above it."""
+    rows, tile = task
+    width = rows.shape[1] - 1
+    tiles = -(-width // tile)
+
+    # the tile and the channel of every residual go into its high bits
+    offsets = ((np.arange(width) // tile)[:, None] * 3 + np.arange(3)) * 256
+
+    bits = np.empty((len(prediction_schemes), tiles, 3))
+    for i, scheme in enumerate(prediction_schemes):
+        values = residuals(rows, scheme) + offsets
+        counts = np.bincount(values.reshape(-1), minlength=tiles * 3 * 256)
+        bits[i] = coding_bits(counts.reshape(tiles, 3, 256))
+
+    return bits
+
+
+class TileSelection:
+    """The prediction scheme chosen for every tile and channel.
+
+    bits holds the bits every scheme needs for every tile and channel, as
+    a (schemes, tile rows, tile columns, 3) array.
+    """
+
+    def __init__(self, bits, tile):
+        self.bits = bits
+        self.tile = tile
+
+    @property
+    def schemes(self):
+        """The side table, scheme numbers from 1 by tile row, tile column
+        and channel."""
+        return (self.bits.argmin(axis=0) + 1).astype(np.uint8)
+
+    def global_bits(self):
+        """Bits needed with the best scheme of every channel for all tiles."""
+        return float(self.bits.sum(axis=(1, 2)).min(axis=0).sum())
+
+    def tiled_bits(self):
+        return float(self.bits.min(axis=0).sum())
+
+    def side_bits(self):
+        """Bits of the side table, with every choice in a fixed length."""
+        return self.schemes.size * (len(self.bits) - 1).bit_length()
+
+    def saved_bits(self):
+        return self.global_bits() - self.tiled_bits() - self.side_bits()
+
+
+def select_tile_schemes(bitmap, tile=64, jobs=None):
+    """Picks the prediction scheme of every tile and channel, the rows of
+    tiles are handled by jobs processes."""
+    padded = padded_pixels(bitmap)
+    tasks = ((padded[top:top + tile + 1], tile) for top in range(0, len(padded) - 1, tile))
+
+    return TileSelection(np.stack(list(ordered_map(tile_row_bits, tasks, jobs)), axis=1), tile)
+
+
+def print_tile_selection(selection):
+    rows, columns = selection.schemes.shape[:2]
+    print(f'Tiles: {columns}x{rows} of {selection.tile}x{selection.tile}')
+    print(f'Bits with the best scheme per channel: {selection.global_bits()}')
+    print(f'Bits with a scheme per tile: {selection.tiled_bits()}')
+    print(f'Side table bits: {selection.side_bits()}')
+    print(f'Saved bits: {selection.saved_bits()}')
+    for i in range(1, len(selection.bits) + 1):
+        print(f'Scheme {i} tiles:', (selection.schemes == i).sum(axis=(0, 1)).tolist())
+
+
+# LOCO-I, the algorithm behind lossless JPEG-LS, for 8 bit samples
+MAXVAL = 255
+RANGE = 256
+# thresholds of the gradient quantization
+T1, T2, T3 = 3, 7, 21
+# the statistics of a context are halved once it is seen RESET times
+RESET = 64
+# longest Golomb code, larger errors are written as plain QBPP bit values
+LIMIT = 32
+QBPP = 8
+# the unary part of a Golomb code that means the value follows as is
+ESCAPE = LIMIT - QBPP - 1
+CONTEXTS = 365
+
+
+def quantize_gradient(d):
+    if d <= -T3:
+        return -4
+    elif d <= -T2:
+        return -3
+    elif d <= -T1:
+        return -2
+    elif d < 0:
+        return -1
+    elif d == 0:
+        return 0
+    elif d < T1:
+        return 1
+    elif d < T2:
+        return 2
+    elif d < T3:
+        return 3
+    else:
+        return 4
+
 
-        if blue < best_blue:
-            best_blue = blue
-            best_blue_no = i
+# GRADIENT_LEVELS[d + MAXVAL] is the quantized gradient d
+GRADIENT_LEVELS = [quantize_gradient(d) for d in range(-MAXVAL, MAXVAL + 1)]
 
 
-    print(f'Best general: {best_general_no}')
-    print(f'Best red: {best_red_no}')
-    print(f'Best green: {best_green_no}')
-    print(f'Best blue: {best_blue_no}')
+def loco_neighbours(plane):
+    """Returns a, b, c and d, the west, north, north west and north east
+    neighbours of every sample. Above the first row all samples are 0,
+    left of a row is the first sample of the row above and right of it
+    is the last one, as in JPEG-LS."""
+    height, width = plane.shape
+
+    # rows of the plane with the one above, one more sample on each side
+    extended = np.zeros((height + 1, width + 2), dtype=np.int32)
+    extended[1:, 1:-1] = plane
+    extended[1:, 0] = extended[:-1, 1]
+    extended[:, -1] = extended[:, -2]
+
+    return extended[1:, :-2], extended[:-1, 1:-1], extended[:-1, :-2], extended[:-1, 2:]
+
+
+def loco_contexts(a, b, c, d):
+    """Returns the context of every sample and whether its gradients were
+    negated to get there."""
+    levels = np.array(GRADIENT_LEVELS)
+    q = (levels[d - b + MAXVAL] * 81 + levels[b - c + MAXVAL] * 9 + levels[c - a + MAXVAL])
+
+    return np.abs(q), q < 0
+
+
+def golomb_parameter(n, a):
+    k = 0
+    while (n << k) < a:
+        k += 1
+
+    return k
+
+
+def loco_encode(plane):
+    """Codes a (height, width) plane of 8 bit samples, returns the bits."""
+    a, b, c, d = loco_neighbours(plane)
+    contexts, negative = loco_contexts(a, b, c, d)
+    predictions = new_standard(b, a, c)
+
+    A = [max(2, (RANGE + 32) // 64)] * CONTEXTS
+    B = [0] * CONTEXTS
+    C = [0] * CONTEXTS
+    N = [1] * CONTEXTS
+
+    codes = []
+    for x, prediction, q, flip in zip(plane.ravel().tolist(), predictions.ravel().tolist(),
+                                      contexts.ravel().tolist(), negative.ravel().tolist()):
+        # bias correction
+        if flip:
+            prediction -= C[q]
+        else:
+            prediction += C[q]
+        prediction = min(max(prediction, 0), MAXVAL)
+
+        error = prediction - x if flip else x - prediction
+        # modulo RANGE, into [-RANGE / 2, RANGE / 2)
+        if error < 0:
+            error += RANGE
+        if error >= RANGE // 2:
+            error -= RANGE
+
+        n = N[q]
+        k = golomb_parameter(n, A[q])
+
+        if k == 0 and 2 * B[q] <= -n:
+            mapped = 2 * error + 1 if error >= 0 else -2 * (error + 1)
+        else:
+            mapped = 2 * error if error >= 0 else -2 * error - 1
+
+        # unary high part, a 1 and k low bits
+        high = mapped >> k
+        if high < ESCAPE:
+            codes.append(((1 << k) | (mapped & ((1 << k) - 1)), high + 1 + k))
+        else:
+            codes.append(((1 << QBPP) | (mapped - 1), LIMIT))
+
+        update_context(A, B, C, N, q, error)
+
+    writer = BitWriter()
+    writer.write_codes(codes)
+
+    return writer.getvalue()
+
+
+def update_context(A, B, C, N, q, error):
+    B[q] += error
+    A[q] += abs(error)
+    if N[q] == RESET:
+        A[q] >>= 1
+        B[q] >>= 1
+        N[q] >>= 1
+    N[q] += 1
+
+    n = N[q]
+    if B[q] <= -n:
+        B[q] += n
+        if C[q] > -RANGE // 2:
+            C[q] -= 1
+        if B[q] <= -n:
+            B[q] = -n + 1
+    elif B[q] > 0:
+        B[q] -= n
+        if C[q] < RANGE // 2 - 1:
+            C[q] += 1
+        if B[q] > 0:
+            B[q] = 0
+
+
+def loco_decode(data, height, width):
+    """Decodes a plane coded by loco_encode."""
+    reader = BitReader(data)
+    levels = GRADIENT_LEVELS
+
+    A = [max(2, (RANGE + 32) // 64)] * CONTEXTS
+    B = [0] * CONTEXTS
+    C = [0] * CONTEXTS
+    N = [1] * CONTEXTS
+
+    peek_bits = reader.peek_bits
+
+    plane = np.empty((height, width), dtype=np.uint8)
+    prev = [0] * (width + 2)
+    for y in range(height):
+        row = [0] * (width + 2)
+        row[0] = prev[1]
+
+        for i in range(width):
+            a = row[i]
+            b = prev[i + 1]
+            c = prev[i]
+
+            q = (levels[prev[i + 2] - b + MAXVAL] * 81 + levels[b - c + MAXVAL] * 9
+                 + levels[c - a + MAXVAL])
+            flip = q < 0
+            if flip:
+                q = -q
+
+            # new_standard for a single sample
+            if c >= max(a, b):
+                prediction = min(a, b)
+            elif c <= min(a, b):
+                prediction = max(a, b)
+            else:
+                prediction = a + b - c
+
+            if flip:
+                prediction -= C[q]
+            else:
+                prediction += C[q]
+            prediction = min(max(prediction, 0), MAXVAL)
+
+            n = N[q]
+            k = golomb_parameter(n, A[q])
+
+            # no code is longer than LIMIT, so one window holds all of it
+            available = min(reader.end - reader.position, LIMIT)
+            window = peek_bits(available)
+            high = available - window.bit_length()
+            if high < ESCAPE:
+                length = high + 1 + k
+                mapped = (high << k) | ((window >> (available - length)) & ((1 << k) - 1))
+            else:
+                length = LIMIT
+                mapped = ((window >> (available - length)) & ((1 << QBPP) - 1)) + 1
+            reader.position += length
+
+            if k == 0 and 2 * B[q] <= -n:
+                error = (mapped - 1) >> 1 if mapped & 1 else -(mapped >> 1) - 1
+            else:
+                error = -((mapped + 1) >> 1) if mapped & 1 else mapped >> 1
+
+            update_context(A, B, C, N, q, error)
+
+            x = prediction - error if flip else prediction + error
+            row[i + 1] = x % RANGE
+
+        row[width + 1] = row[width]
+        plane[y] = row[1:width + 1]
+        prev = row
+
+    return plane
+
+
+def encode_plane(plane):
+    return loco_encode(plane), plane.size
+
+
+def decode_plane(task):
+    data, height, width = task
+
+    return loco_decode(data, height, width)
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--encode', dest='mode', action='store_const', const='encode',
+                        default='analyse', help='compress with LOCO-I instead of printing entropies')
+    parser.add_argument('-d', '--decode', dest='mode', action='store_const', const='decode')
+    parser.add_argument('--verify', dest='mode', action='store_const', const='verify',
+                        help='only check the checksums of an encoded file')
+    parser.add_argument('--tiles', dest='tiles', type=positive_int, default=None,
+                        help='also pick a scheme for every square tile of this size')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None,
+                        help='processes coding the color planes or tiles, all cores by default')
+    parser.add_argument('input_file')
+    parser.add_argument('output_file', nargs='?')
+
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+
+    if args.mode == 'verify':
+        report_verification(args.input_file, 'jpeg-ls')
+        return
+
+    if args.mode != 'analyse' and args.output_file is None:
+        get_arg_parser().error('an output file is needed for coding')
+
+    start = perf_counter()
+
+    if args.mode == 'analyse':
+        with map_input(args.input_file) as image:
+            bitmap, _, _ = load_tga(image)
+
+        print_analysis(analyse(bitmap))
+
+        if args.tiles is not None:
+            print('---')
+            print_tile_selection(select_tile_schemes(bitmap, args.tiles, args.jobs))
+        return
+    elif args.mode == 'encode':
+        with map_input(args.input_file) as image:
+            bitmap, header, footer = load_tga(image)
+
+            # the planes are coded apart, like the components of a
+            # non-interleaved JPEG-LS scan
+            planes = [bitmap[..., c] for c in range(3)]
+            with open(args.output_file, 'wb') as out:
+                container = ContainerWriter(out, 'jpeg-ls', header + footer)
+                for payload, size in ordered_map(encode_plane, planes, args.jobs):
+                    container.write_block(payload, size)
+                container.close()
+
+                compressed = out.tell()
+    else:
+        with map_input(args.input_file) as data:
+            if not is_container(data):
+                sys.exit(f'{args.input_file}: not a compressed image')
+
+            try:
+                container = ContainerReader(data)
+                container.check_codec('jpeg-ls')
+            except ValueError as error:
+                sys.exit(f'{args.input_file}: {error}')
+
+            header = container.params[:HEADER_SIZE]
+            footer = container.params[HEADER_SIZE:]
+            compressed = len(data)
+
+            height = header[15] * 256 + header[14]
+            width = header[13] * 256 + header[12]
+            tasks = ((bytes(block), height, width) for block in container.read_blocks())
+            bitmap = np.stack(list(ordered_map(decode_plane, tasks, args.jobs)), axis=-1)
+
+        with open(args.output_file, 'wb') as out:
+            out.write(header + tga_pixels(bitmap) + footer)
+
+    seconds = perf_counter() - start
+    megabytes = bitmap.size / 2**20
+
+    print('Bits per sample:', compressed * 8 / bitmap.size)
+    print('Compression ratio:', bitmap.size / compressed)
+    print(f'Throughput: {megabytes / seconds:.3f} MB/s')
 
 
 if __name__ == "__main__":
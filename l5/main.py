@@ -1,70 +1,131 @@
-from functools import reduce
-from collections import defaultdict
-from sys import argv
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from math import floor, log
-from itertools import chain
+from time import perf_counter
 
+import numpy as np
 
-def generate_codebook(data, size_codebook, epsilon=0.00001):
-    data_size = len(data)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-    codebook = []
+from common.arguments import positive_float, positive_int
+from common.streams import map_input
+from common.tga import file_order, load_tga
 
-    c0 = avg_vec_of_vecs(data)
-    codebook.append(c0)
+# differences between pixels and codevectors computed at once while
+# looking for the closest codevectors
+ASSIGN_CHUNK = 1 << 20
 
-    avg_dist = avg_distortion_c0(c0, data, data_size)
+# the color space is split into at most MAX_GRID_SIZE ** 3 cubes with about
+# ROWS_PER_CELL rows each to find the closest codevectors, small codebooks
+# are searched whole
+MAX_GRID_SIZE = 16
+ROWS_PER_CELL = 256
+BRUTE_FORCE_CODEBOOK = 16
 
-    while len(codebook) < size_codebook:
-        codebook, avg_dist = split_codebook(data, codebook, epsilon, avg_dist)
+# bytes of codebooks kept by a cache by default
+CACHE_SIZE = 64 << 20
+
+
+def generate_codebook(data, size_codebook, epsilon=0.00001, jobs=1,
+                      sample_size=None, max_iterations=None, time_budget=None, cache=None):
+    """Trains a codebook with LBG.
+
+    With sample_size the codebook is trained on a sample of the pixels and
+    then refined on all of them. LBG stops after max_iterations iterations
+    per split and, once time_budget seconds pass, after one iteration.
+
+    With a cache a codebook trained before for the same pixels is reused,
+    or training starts from the largest smaller one it holds.
+    """
+    deadline = None if time_budget is None else perf_counter() + time_budget
+
+    if cache is None:
+        codebook, _ = train_codebook(data, size_codebook, epsilon, jobs,
+                                     sample_size, max_iterations, deadline)
+    else:
+        key = cache.key(data, (epsilon, sample_size, max_iterations))
+
+        cached = cache.get(key, size_codebook)
+        if cached is not None:
+            codebook, _ = cached
+        else:
+            codebook, avg_dist = train_codebook(data, size_codebook, epsilon, jobs, sample_size,
+                                                max_iterations, deadline,
+                                                cache.warm_start(key, size_codebook))
+
+            # LBG only checks the deadline before its iterations, so if it
+            # has not passed yet none was cut short by it
+            if deadline is None or perf_counter() < deadline:
+                cache.put(key, size_codebook, codebook, avg_dist)
 
     return [(floor(b), floor(g), floor(r)) for b, g, r in codebook]
 
 
-def split_codebook(data, codebook, epsilon, initial_avg_dist):
-    data_size = len(data)
+def train_codebook(data, size_codebook, epsilon=0.00001, jobs=1, sample_size=None,
+                   max_iterations=None, deadline=None, start=None):
+    """Returns the codebook before rounding and its average distortion,
+    LBG splits the codebook and distortion of start if given."""
+    sampled = sample_size is not None and sample_size < len(data)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    with training_set(sample_pixels(data, sample_size) if sampled else data, jobs) as training:
+        if start is not None:
+            codebook, avg_dist = start
+        else:
+            c0 = avg_vec_of_vecs(training.data, training.weights)
+            codebook = c0[None, :]
+
+            avg_dist = avg_distortion_c0(c0, training.data, training.weights)
+
+        while len(codebook) < size_codebook:
+            codebook, avg_dist = split_codebook(training, codebook, epsilon, avg_dist,
+                                                max_iterations, deadline)
+
+    if sampled:
+        print("Refining", len(codebook))
 
-    new_codevectors = []
-    for c in codebook:
-        c1 = new_codevector(c, epsilon)
-        c2 = new_codevector(c, -epsilon)
-        new_codevectors.extend((c1, c2))
+        # the distortion of the sample is lower than the one of all the
+        # pixels and would stop the refinement after a single iteration
+        with training_set(data, jobs) as training:
+            training.assign(codebook)
+            avg_dist = training.avg_distortion(codebook)
+            codebook, avg_dist = lbg(training, codebook, epsilon, avg_dist, max_iterations, deadline)
 
-    codebook = new_codevectors
-    len_codebook = len(codebook)
+    return codebook, avg_dist
+
+
+def split_codebook(training, codebook, epsilon, initial_avg_dist, max_iterations=None, deadline=None):
+    codebook = np.stack([new_codevector(codebook, epsilon),
+                         new_codevector(codebook, -epsilon)], axis=1).reshape(-1, 3)
 
-    print("Splitting", len_codebook)
+    print("Splitting", len(codebook))
 
+    return lbg(training, codebook, epsilon, initial_avg_dist, max_iterations, deadline)
+
+
+def lbg(training, codebook, epsilon, initial_avg_dist, max_iterations=None, deadline=None):
     avg_dist = 0
     err = epsilon + 1
     num_iter = 0
     while err > epsilon:
-        closest_c_list = [None] * data_size
-        vecs_near_c = defaultdict(list)
-        vec_idxs_near_c = defaultdict(list)
-        for i, vec in enumerate(data):
-            min_dist = None
-            closest_c_index = None
-            for i_c, c in enumerate(codebook):
-                d = euclid_squared(vec, c)
-                if min_dist is None or d < min_dist:
-                    min_dist = d
-                    closest_c_list[i] = c
-                    closest_c_index = i_c
-            vecs_near_c[closest_c_index].append(vec)
-            vec_idxs_near_c[closest_c_index].append(i)
-
-        for i_c in range(len_codebook):
-            vecs = vecs_near_c.get(i_c) or []
-            num_vecs_near_c = len(vecs)
-            if num_vecs_near_c > 0:
-                new_c = avg_vec_of_vecs(vecs)
-                codebook[i_c] = new_c
-                for i in vec_idxs_near_c[i_c]:
-                    closest_c_list[i] = new_c
+        if num_iter > 0 and (num_iter == max_iterations or
+                             deadline is not None and perf_counter() > deadline):
+            break
+
+        counts, sums = training.assign(codebook)
+
+        # codevectors nobody is close to stay where they are
+        near = counts > 0
+        codebook[near] = sums[near] / counts[near, None]
 
         prev_avg_dist = avg_dist if avg_dist > 0 else initial_avg_dist
-        avg_dist = avg_distortion_c_list(closest_c_list, data, data_size)
+        avg_dist = training.avg_distortion(codebook)
 
         err = (prev_avg_dist - avg_dist) / prev_avg_dist
 
@@ -73,82 +134,351 @@ def split_codebook(data, codebook, epsilon, initial_avg_dist):
     return codebook, avg_dist
 
 
-def avg_vec_of_vecs(vecs):
-    size = len(vecs)
-    avg_vec = [0.0] * 3
-    for vec in vecs:
-        for i, x in enumerate(vec):
-            avg_vec[i] += x / size
+def sample_pixels(data, size, seed=0):
+    """Returns a random pixel from each of size equal runs of pixels."""
+    bounds = np.linspace(0, len(data), size + 1).astype(np.int64)
+    offsets = np.random.default_rng(seed).random(size) * (bounds[1:] - bounds[:-1])
+
+    return data[bounds[:-1] + offsets.astype(np.int64)]
+
+
+def training_set(data, jobs):
+    """Returns the distinct colors of data weighted by the number of their
+    pixels, shared by jobs processes when there are more of them."""
+    colors, weights, _ = unique_colors(data)
+    colors = colors.astype(np.float64)
+
+    if jobs > 1:
+        return SharedTrainingSet(colors, weights, jobs)
+    return TrainingSet(colors, weights)
+
+
+class TrainingSet:
+    """The colors a codebook is trained on with their weights, remembering
+    the codevector closest to every color between the steps of LBG."""
+
+    def __init__(self, data, weights):
+        self.data = data
+        self.weights = weights
+        self.closest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def assign(self, codebook):
+        """Finds the closest codevectors, returns the weight of the colors
+        closest to every codevector and their weighted sums."""
+        self.closest, counts, sums = assign_colors(self.data, self.weights, codebook)
+        return counts, sums
+
+    def avg_distortion(self, codebook):
+        return avg_distortion_c_list(codebook[self.closest], self.data, self.weights)
+
+    def close(self):
+        pass
+
+
+class SharedTrainingSet(TrainingSet):
+    """A training set split into a shard per process.
+
+    The arrays are kept in files of a temporary directory, which the
+    processes map instead of receiving copies. Only the codebook goes to
+    them and only sums per codevector come back.
+    """
+
+    def __init__(self, data, weights, jobs):
+        self.directory = tempfile.TemporaryDirectory()
+
+        arrays = {}
+        for name, array in (("data", data), ("weights", weights),
+                            ("closest", np.zeros(len(data), dtype=np.intp))):
+            path = os.path.join(self.directory.name, name + ".npy")
+            arrays[name] = np.lib.format.open_memmap(path, "w+", array.dtype, array.shape)
+            arrays[name][:] = array
+            arrays[name].flush()
+
+        super().__init__(arrays["data"], arrays["weights"])
+        self.closest = arrays["closest"]
+
+        bounds = np.linspace(0, len(data), jobs + 1).astype(int)
+        self.shards = list(zip(bounds[:-1], bounds[1:]))
+        self.executor = ProcessPoolExecutor(jobs)
+
+    def tasks(self, codebook):
+        return [(self.directory.name, start, end, codebook) for start, end in self.shards]
+
+    def assign(self, codebook):
+        results = list(self.executor.map(assign_shard, self.tasks(codebook)))
+
+        return sum(counts for counts, _ in results), sum(sums for _, sums in results)
+
+    def avg_distortion(self, codebook):
+        return sum(self.executor.map(shard_distortion, self.tasks(codebook))) / self.weights.sum()
+
+    def close(self):
+        self.executor.shutdown()
+        self.data = self.weights = self.closest = None
+        self.directory.cleanup()
+
+
+def load_shard(directory, start, end):
+    return [np.load(os.path.join(directory, name + ".npy"), mmap_mode="r+")[start:end]
+            for name in ("data", "weights", "closest")]
+
+
+def assign_shard(task):
+    directory, start, end, codebook = task
+    data, weights, closest = load_shard(directory, start, end)
 
-    return avg_vec
+    closest[:], counts, sums = assign_colors(data, weights, codebook)
+    return counts, sums
+
+
+def shard_distortion(task):
+    directory, start, end, codebook = task
+    data, weights, closest = load_shard(directory, start, end)
+
+    return (euclid_squared(data, codebook[closest]) * weights).sum()
+
+
+def assign_colors(data, weights, codebook):
+    """Returns the closest codevectors of data, the weight of the data
+    closest to every codevector and the weighted sums of that data."""
+    closest = nearest_codevectors(data, codebook)
+
+    counts = np.bincount(closest, weights, len(codebook))
+    sums = np.stack([np.bincount(closest, data[:, i] * weights, len(codebook))
+                     for i in range(3)], axis=1)
+
+    return closest, counts, sums
+
+
+def nearest_codevectors(data, codebook):
+    """Returns the index of the codevector closest to every row of data.
+
+    Rows are grouped by the cell of a grid over the color space they fall
+    in and compared only against the codevectors that can be the closest
+    to some point of the cell, so the work grows slower than the codebook.
+    A codevector is kept when its distance to the cell's bounding box is
+    at most the smallest distance any codevector has to the box's far
+    corner, which keeps every codevector tying for the closest as well.
+    """
+    codebook = np.asarray(codebook, dtype=np.float64)
+    if len(codebook) <= BRUTE_FORCE_CODEBOOK:
+        return brute_force_nearest(data, codebook)
+
+    grid_size = int(np.clip(np.cbrt(len(data) / ROWS_PER_CELL), 1, MAX_GRID_SIZE))
+    coordinates = np.clip(data * (grid_size / 256), 0, grid_size - 1).astype(np.uint16)
+    cells = (coordinates[:, 0] * grid_size + coordinates[:, 1]) * grid_size + coordinates[:, 2]
+
+    # stable sorting of 16 bit keys is a radix sort
+    order = np.argsort(cells, kind="stable")
+    ends = np.cumsum(np.bincount(cells, minlength=grid_size ** 3))
+
+    closest = np.empty(len(data), dtype=np.intp)
+    start = 0
+    for end in ends[np.flatnonzero(np.diff(ends, prepend=0))]:
+        rows = order[start:end]
+        chunk = data[rows].astype(np.float64)
+        low, high = chunk.min(axis=0), chunk.max(axis=0)
+
+        nearest_corner = np.maximum(np.maximum(low - codebook, codebook - high), 0)
+        far_corner = np.maximum(codebook - low, high - codebook)
+        far_distances = euclid_squared(far_corner, 0)
+        candidates = np.flatnonzero(euclid_squared(nearest_corner, 0) <= far_distances.min())
+
+        closest[rows] = candidates[brute_force_nearest(chunk, codebook[candidates])]
+        start = end
+
+    return closest
+
+
+def brute_force_nearest(data, codebook):
+    """Compares data against the whole codebook in chunks of rows, sized so
+    the distances of a chunk have about ASSIGN_CHUNK elements."""
+    rows = max(1, ASSIGN_CHUNK // len(codebook))
+
+    closest = np.empty(len(data), dtype=np.intp)
+    for start in range(0, len(data), rows):
+        chunk = data[start:start + rows].astype(np.float64)
+
+        # a channel at a time, it is faster than summing a 3D array
+        distances = np.zeros((len(chunk), len(codebook)))
+        for i in range(3):
+            diffs = chunk[:, i, None] - codebook[None, :, i]
+            diffs *= diffs
+            distances += diffs
+
+        closest[start:start + rows] = distances.argmin(axis=1)
+
+    return closest
+
+
+def avg_vec_of_vecs(vecs, weights):
+    return (vecs * weights[:, None]).sum(axis=0) / weights.sum()
 
 
 def new_codevector(c, e):
-    return [x * (1.0 + e) for x in c]
+    return c * (1.0 + e)
 
 
-def avg_distortion_c0(c0, data, size):
-    return reduce(
-        lambda s, d: s + d / size, (euclid_squared(c0, vec)
-                                    for vec in data), 0.0
-    )
+def avg_distortion_c0(c0, data, weights):
+    return (euclid_squared(data, c0) * weights).sum() / weights.sum()
 
 
-def avg_distortion_c_list(c_list, data, size):
-    return reduce(
-        lambda s, d: s + d / size,
-        (euclid_squared(c_i, data[i]) for i, c_i in enumerate(c_list)),
-        0.0,
-    )
+def avg_distortion_c_list(c_list, data, weights):
+    return (euclid_squared(data, c_list) * weights).sum() / weights.sum()
 
 
 def euclid_squared(a, b):
-    return sum((x_a - x_b) ** 2 for x_a, x_b in zip(a, b))
+    return ((a - b) ** 2).sum(axis=-1)
+
+
+class CodebookCache:
+    """Codebooks trained before, kept in a directory as .npz files named
+    after a hash of the pixels and training settings and the codebook size.
+
+    Codebooks are kept before rounding, with their average distortion, so
+    training can go on from them. The least recently used ones are removed
+    once the files take more than max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(bitmap, settings):
+        digest = hashlib.sha256(repr((bitmap.shape, settings)).encode())
+        digest.update(np.ascontiguousarray(bitmap, np.uint8))
+
+        return digest.hexdigest()
+
+    def path(self, key, size):
+        return os.path.join(self.directory, f"{key}-{size}.npz")
+
+    def get(self, key, size):
+        """Returns the codebook and its distortion or None if not cached."""
+        path = self.path(key, size)
+
+        try:
+            with np.load(path) as cached:
+                codebook, avg_dist = cached["codebook"], float(cached["avg_dist"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # the modification time orders codebooks by their last use
+        os.utime(path)
+        return codebook, avg_dist
 
+    def warm_start(self, key, size):
+        """Returns the largest cached codebook that splits into size codevectors."""
+        size //= 2
+        while size >= 1:
+            cached = self.get(key, size)
+            if cached is not None:
+                print("Starting from", size)
+                return cached
+            size //= 2
 
-def parse_bitmap(bitmap, width, height):
-    return [(bitmap[i * 3], bitmap[i * 3 + 1], bitmap[i * 3 + 2]) for i in range(width*height)]
+        return None
+
+    def put(self, key, size, codebook, avg_dist):
+        path = self.path(key, size)
+
+        # written aside and renamed, so no one reads a partial file
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as f:
+            np.savez(f, codebook=codebook, avg_dist=avg_dist)
+        os.replace(f.name, path)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            os.remove(path)
+            total -= size
+
+
+def unique_colors(bitmap):
+    """Returns the distinct colors of a bitmap of 8 bit samples, how many
+    pixels have each of them and the index of the color of every pixel."""
+    keys = bitmap.astype(np.int32)
+    keys = (keys[:, 0] << 16) | (keys[:, 1] << 8) | keys[:, 2]
+
+    keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    colors = np.stack([keys >> 16, (keys >> 8) & 0xff, keys & 0xff], axis=1)
+
+    return colors, counts, inverse
 
 
 def quantify(bitmap, codebook):
-    new_bitmap = []
-    for pixel in bitmap:
-        diffs = [euclid_squared(pixel, x) for x in codebook]
-        new_bitmap.append(codebook[diffs.index(min(diffs))])
-    return new_bitmap
+    codebook = np.array(codebook, dtype=np.int64)
+    colors, _, inverse = unique_colors(bitmap)
+
+    return codebook[nearest_codevectors(colors, codebook)][inverse]
 
 
 def bitmap_to_bytes(bitmap):
-    return bytes(list(chain.from_iterable(bitmap)))
+    return bitmap.astype(np.uint8).tobytes()
 
 
 def mse(original, new):
-    return (1 / len(original)) * sum(
-        euclid_squared(original[i], new[i]) for i in range(len(original))
-    )
+    diffs = original.astype(np.int64) - new
+    return (1 / len(original)) * int((diffs ** 2).sum())
 
 
 def snr(x, mserr):
-    return ((1 / len(x)) * sum(sum(xij**2 for xij in xi) for xi in x)) / mserr
+    return ((1 / len(x)) * int((x.astype(np.int64) ** 2).sum())) / mserr
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file")
+    parser.add_argument("output_file")
+    parser.add_argument("exponent", type=int, help="the codebook has 2 ** exponent colors")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=None,
+                        help="processes training the codebook, all cores by default")
+    parser.add_argument("--sample", dest="sample_size", type=positive_int, default=None,
+                        help="train on this many pixels, then refine on all of them")
+    parser.add_argument("--max-iterations", dest="max_iterations", type=positive_int, default=None,
+                        help="iterations of LBG after every split at most")
+    parser.add_argument("--time-budget", dest="time_budget", type=positive_float, default=None,
+                        help="seconds after which LBG does a single iteration per split")
+    parser.add_argument("--cache", dest="cache", default=None,
+                        help="directory keeping trained codebooks for later runs")
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=CACHE_SIZE,
+                        help="bytes of codebooks the cache keeps at most")
+
+    return parser
 
 
 def main():
-    if len(argv) != 4:
-        print("main.py [input image] [output image] [color number exponent]")
-        return
+    args = get_arg_parser().parse_args()
 
-    with open(argv[1], "rb") as f:
-        tga = f.read()
+    with map_input(args.input_file) as tga:
+        pixels, header, footer = load_tga(tga)
+        original_bitmap = file_order(pixels)
 
-    header = tga[:18]
-    footer = tga[-26:]
-    width = tga[13] * 256 + tga[12]
-    height = tga[15] * 256 + tga[14]
-    original_bitmap = parse_bitmap(
-        tga[18:-26], width, height)
+    cache = None if args.cache is None else CodebookCache(args.cache, args.cache_size)
 
-    codebook = generate_codebook(
-        original_bitmap, 2 ** int(argv[3]))
+    codebook = generate_codebook(original_bitmap, 2 ** args.exponent, jobs=args.jobs,
+                                 sample_size=args.sample_size, max_iterations=args.max_iterations,
+                                 time_budget=args.time_budget, cache=cache)
 
     new_bitmap = quantify(original_bitmap, codebook)
     payload = bitmap_to_bytes(new_bitmap)
@@ -159,7 +489,7 @@ def main():
     print("MSE:", mserr)
     print("SNR:", 10 * log(snratio, 10), "dB")
 
-    with open(argv[2], "wb") as f:
+    with open(args.output_file, "wb") as f:
         f.write(header + payload + footer)
 
 
@@ -1,5 +1,12 @@
+import os
+import sys
 from sys import argv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.bits import BitReader
+from common.streams import map_input
+
 if len(argv) != 3:
     print("not enough arguments")
     exit(1)
@@ -8,20 +15,14 @@ file1 = argv[1]
 file2 = argv[2]
 
 
-with open(file1, "rb") as f:
-    contents = f.read()
-
-bitstring1 = ''.join("{0:08b}".format(byte) for byte in contents)
-
-with open(file2, "rb") as f:
-    contents = f.read()
-
-bitstring2 = ''.join("{0:08b}".format(byte) for byte in contents)
-
+with map_input(file1) as contents1, map_input(file2) as contents2:
+    reader1 = BitReader(contents1)
+    reader2 = BitReader(contents2)
 
-l = min(len(bitstring1), len(bitstring2))
-size_diff = abs(len(bitstring1) - len(bitstring2)) // 4
+    size_diff = abs(reader1.remaining - reader2.remaining) // 4
 
-diffs_count = len([1 for i in range(0, l, 4) if bitstring1[i:i+4] == bitstring2[i:i+4]])
+    diffs_count = 0
+    while reader1.remaining >= 4 and reader2.remaining >= 4:
+        diffs_count += reader1.read_bits(4) == reader2.read_bits(4)
 
-print(diffs_count + size_diff)
\ No newline at end of file
+print(diffs_count + size_diff)
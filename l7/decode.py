@@ -1,41 +1,46 @@
+import os
+import sys
 from sys import argv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.bits import BitReader, BitWriter
+from common.streams import CHUNK_SIZE, map_input
+
 codes = [
-    "00000000",
-    "11010010",
-    "01010101",
-    "10000111",
-    "10011001",
-    "01001011",
-    "11001100",
-    "00011110",
-    "11100001",
-    "00110011",
-    "10110100",
-    "01100110",
-    "01111000",
-    "10101010",
-    "00101101",
-    "11111111",
+    0b00000000,
+    0b11010010,
+    0b01010101,
+    0b10000111,
+    0b10011001,
+    0b01001011,
+    0b11001100,
+    0b00011110,
+    0b11100001,
+    0b00110011,
+    0b10110100,
+    0b01100110,
+    0b01111000,
+    0b10101010,
+    0b00101101,
+    0b11111111,
 ]
 
-errors = 0
 
-def decode(bits):
+def decode(byte):
+    """Returns the decoded nibble and whether a double error was found."""
     for code in codes:
-        diffs = 0
-        for bit1, bit2 in zip(bits, code):
-            if bit1 != bit2:
-                diffs += 1
+        diffs = bin(byte ^ code).count("1")
 
         if diffs in (0, 1):
-            return code[2] + code[4] + code[5] + code[6]
+            return ((code >> 5) & 1) << 3 | ((code >> 1) & 0b111), False
         elif diffs == 2:
-            global errors
-            errors += 1
-            return "0000"
+            return 0, True
+
+    return 0, False
+
 
-    return "0000"
+decoded_bytes = [decode(byte) for byte in range(256)]
 
 
 if len(argv) != 3:
@@ -45,14 +50,18 @@ if len(argv) != 3:
 input_file = argv[1]
 output_file = argv[2]
 
-with open(input_file, "rb") as f:
-    contents = f.read()
-
-decoded = ''.join(decode("{0:08b}".format(byte)) for byte in contents)
+errors = 0
+with map_input(input_file) as contents, open(output_file, "wb") as f:
+    reader = BitReader(contents)
+    writer = BitWriter()
+    while reader.remaining > 0:
+        nibble, error = decoded_bytes[reader.read_bits(8)]
+        errors += error
+        writer.write_bits(nibble, 4)
 
-output = bytes(int(decoded[i:i+8], 2) for i in range(0, len(decoded), 8))
-print(f'found 2 errors {errors} times')
+        if len(writer.buffer) >= CHUNK_SIZE:
+            f.write(writer.pop_bytes())
 
+    f.write(writer.getvalue())
 
-with open(output_file, "wb") as f:
-    f.write(output)
+print(f'found 2 errors {errors} times')
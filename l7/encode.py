@@ -1,17 +1,34 @@
+import os
+import sys
 from sys import argv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.bits import BitReader, BitWriter
+from common.streams import CHUNK_SIZE, map_input
+
 
 def parity(bits, ids):
-    return str(len([1 for i in ids if bits[i] == "1"]) % 2)
+    return sum(bits[i] for i in ids) % 2
 
 
-def hamming(bits):
+def hamming(nibble):
+    bits = [(nibble >> i) & 1 for i in (3, 2, 1, 0)]
+
     p1 = parity(bits, [0, 1, 3])
     p2 = parity(bits, [0, 2, 3])
     p3 = parity(bits, [1, 2, 3])
-    p = parity(p1 + p2 + bits[0] + p3 + bits[1:], range(7))
+    code = [p1, p2, bits[0], p3] + bits[1:]
+    code.append(parity(code, range(7)))
+
+    result = 0
+    for bit in code:
+        result = (result << 1) | bit
 
-    return p1 + p2 + bits[0] + p3 + bits[1:] + p
+    return result
+
+
+codes = [hamming(nibble) for nibble in range(16)]
 
 
 if len(argv) != 3:
@@ -21,14 +38,13 @@ if len(argv) != 3:
 input_file = argv[1]
 output_file = argv[2]
 
-with open(input_file, "rb") as f:
-    contents = f.read()
-
-bitstring = ''.join("{0:08b}".format(byte) for byte in contents)
-
-encoded = bytes(int(hamming(bitstring[i:i+4]), 2)
-                    for i in range(0, len(bitstring), 4))
+with map_input(input_file) as contents, open(output_file, "wb") as f:
+    reader = BitReader(contents)
+    writer = BitWriter()
+    while reader.remaining > 0:
+        writer.write_bits(codes[reader.read_bits(4)], 8)
 
+        if len(writer.buffer) >= CHUNK_SIZE:
+            f.write(writer.pop_bytes())
 
-with open(output_file, "wb") as f:
-    f.write(encoded)
+    f.write(writer.getvalue())
@@ -1,6 +1,13 @@
+import os
+import sys
 from sys import argv
 import random
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.bits import BitReader, BitWriter
+from common.streams import CHUNK_SIZE, map_input
+
 if len(argv) != 4:
     print("not enough arguments")
     exit(1)
@@ -9,14 +16,16 @@ p = float(argv[1])
 input_file = argv[2]
 output_file = argv[3]
 
-with open(input_file, "rb") as f:
-    contents = f.read()
-
-bitstring = ''.join("{0:08b}".format(byte) for byte in contents)
-new_bitstring = ''.join(str(int(not int(bit)))
-                        if random.random() <= p else bit for bit in bitstring)
+with map_input(input_file) as contents, open(output_file, "wb") as f:
+    reader = BitReader(contents)
+    writer = BitWriter()
+    while reader.remaining > 0:
+        mask = 0
+        for i in range(8):
+            mask = (mask << 1) | (random.random() <= p)
+        writer.write_bits(reader.read_bits(8) ^ mask, 8)
 
-output = bytes(int(new_bitstring[i:i+8], 2) for i in range(0, len(new_bitstring), 8))
+        if len(writer.buffer) >= CHUNK_SIZE:
+            f.write(writer.pop_bytes())
 
-with open(output_file, "wb") as f:
-    f.write(output)
\ No newline at end of file
+    f.write(writer.getvalue())